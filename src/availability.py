@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+
+import os
+import queue
+import threading
+import find
+
+workers_var = "PLAY_EPISODE_CHECK_WORKERS"
+timeout_var = "PLAY_EPISODE_CHECK_TIMEOUT"
+max_workers = 8
+#Seconds a path can take before its entries are reported as offline
+default_timeout = 2.0
+
+AVAILABLE = "available"
+MISSING = "missing"
+OFFLINE = "offline"
+
+class Checker:
+  """Checks in the background whether the episodes of entries exist.
+
+  Entries are grouped by path, and each path is looked up by one of at
+  most "workers" threads. If a path isn't looked up within "timeout"
+  seconds from the call to check(), as with an unmounted network drive,
+  or with the workers all stuck on one, its entries are reported as
+  offline; they're reported again if the lookup ever completes. The
+  episode index is saved once each time the queue of paths empties.
+
+  The threads are daemons, rather than the ones of a ThreadPoolExecutor,
+  which are joined when the program exits: a thread stuck on a dead mount
+  must not keep the program from exiting.
+  """
+  def __init__(self, workers = None, timeout = None, finder = find):
+    """Creates a checker.
+
+    Args:
+      workers: Optional. The maximum number of paths checked at the same
+               time. Default value: the environment variable
+               "PLAY_EPISODE_CHECK_WORKERS" if set, "max_workers"
+               otherwise.
+      timeout: Optional. The seconds after which a path is reported as
+               offline. Default value: the environment variable
+               "PLAY_EPISODE_CHECK_TIMEOUT" if set, "default_timeout"
+               otherwise.
+      finder: Optional. The find module, or an object with its interface
+              such as a daemon.RemoteFinder, used to look up the
+              episodes.
+    """
+    if workers == None:
+      workers = int(os.environ.get(workers_var, max_workers))
+    if timeout == None:
+      timeout = float(os.environ.get(timeout_var, default_timeout))
+    self.workers = max(workers, 1)
+    self.timeout = timeout
+    self.finder = finder
+    self._queue = queue.Queue()
+    self._threads = []
+    self._lock = threading.Lock()
+    self._busy = 0
+
+  def check(self, items, report):
+    """Schedules the check of some entries, returning immediately.
+
+    Args:
+      items: An iterable of tuples (key, entry); "entry" shouldn't change
+             while it's checked.
+      report: A function called as report(key, entry, state) from a
+              background thread, where "state" is AVAILABLE, MISSING or
+              OFFLINE.
+    """
+    paths = {}
+    for (key, entry) in items:
+      paths.setdefault(entry.path, []).append((key, entry))
+    if not paths:
+      return
+    batch = _Batch(list(paths.values()), report, self.timeout)
+    for i in range(len(batch.groups)):
+      self._queue.put((batch, i))
+    while len(self._threads) < min(self.workers, self._queue.qsize()):
+      thread = threading.Thread(target=self._run, daemon=True)
+      thread.start()
+      self._threads.append(thread)
+
+  def _run(self):
+    while True:
+      (batch, i) = self._queue.get()
+      with self._lock:
+        self._busy += 1
+      self._check_group(batch, i)
+      with self._lock:
+        self._busy -= 1
+        drained = self._busy == 0 and self._queue.empty()
+      if drained:
+        find.index.flush()
+
+  def _check_group(self, batch, i):
+    results = []
+    for (key, entry) in batch.groups[i]:
+      try:
+        self.finder.find_file(entry, save=False)
+        results.append((key, entry, AVAILABLE))
+      except find.NotFoundError:
+        results.append((key, entry, MISSING))
+      except OSError:
+        results.append((key, entry, OFFLINE))
+    batch.finish(i)
+    for result in results:
+      batch.report(*result)
+
+class _Batch:
+  """The groups of entries of a call to Checker.check().
+
+  A single timer is started for all of them; the groups not checked yet
+  when it expires are reported as offline.
+  """
+  def __init__(self, groups, report, timeout):
+    self.groups = groups
+    self.report = report
+    self._pending = set(range(len(groups)))
+    self._lock = threading.Lock()
+    self._timer = threading.Timer(timeout, self._expire)
+    self._timer.daemon = True
+    self._timer.start()
+
+  def finish(self, i):
+    """Marks the group "i" as checked, before its results are reported."""
+    with self._lock:
+      self._pending.discard(i)
+      if not self._pending:
+        self._timer.cancel()
+
+  def _expire(self):
+    with self._lock:
+      for i in sorted(self._pending):
+        for (key, entry) in self.groups[i]:
+          self.report(key, entry, OFFLINE)
+      self._pending.clear()
@@ -0,0 +1,186 @@
+#! /usr/bin/env python3
+
+"""Benchmarks of the episode lookup and of the data file.
+
+Generates synthetic libraries in a temporary directory and times
+find.find_file(), Data.get_data() and Data.save_data() on them, printing
+a table. Results can be saved and compared with a previous run:
+
+  bench.py --sizes 10x24,100x24 --save baseline.json
+  bench.py --sizes 10x24,100x24 --compare baseline.json --threshold 1.25
+
+The exit status is 1 if any timing is slower than the saved one by more
+than the threshold.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import data
+import find
+
+styles = ("{name}.S{season:02d}E{episode:02d}.720p.{ext}",
+          "{name} {season}x{episode:02d} - Title.{ext}",
+          "{name}_s{season}e{episode}_hdtv.{ext}")
+extensions = ("mkv", "mp4", "avi")
+seasons = 4
+
+def generate_library(root, n_series, n_episodes, layout = "nested"):
+  """Generates a synthetic library of empty files.
+
+  Each series uses a different naming style and video extension, and
+  every other episode has a subtitle.
+
+  Args:
+    root: The directory where to create the library.
+    n_series: The number of series.
+    n_episodes: The number of episodes of each series, split in "seasons"
+                seasons.
+    layout: Optional. "nested" to put each series in its own directory,
+            "flat" to put all the files in "root".
+
+  Returns:
+    A list of data.Entry, one for each series, pointing to its last
+    episode.
+  """
+  entries = []
+  per_season = max(n_episodes // seasons, 1)
+  for i in range(n_series):
+    name = "Series {}".format(i)
+    if layout == "flat":
+      path = root
+    else:
+      path = os.path.join(root, name)
+    os.makedirs(path, exist_ok=True)
+    style = styles[i % len(styles)]
+    ext = extensions[i % len(extensions)]
+    for k in range(n_episodes):
+      (season, episode) = (k // per_season + 1, k % per_season + 1)
+      fields = {"name": name.replace(" ", "."), "season": season,
+                "episode": episode}
+      open(os.path.join(path, style.format(ext=ext, **fields)), "w").close()
+      if k % 2 == 0:
+        open(os.path.join(path, style.format(ext="srt", **fields)),
+             "w").close()
+    entries.append(data.Entry(name, season, episode, path))
+  return entries
+
+def timed(function, repeat = 5):
+  """Returns the best time, in seconds, of "repeat" calls to function."""
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    if best == None or elapsed < best:
+      best = elapsed
+  return best
+
+def bench_find(tmp, entries):
+  index_path = os.path.join(tmp, "bench.index")
+  def cold():
+    if os.path.exists(index_path):
+      os.remove(index_path)
+    find.index = find.Index(index_path)
+    for entry in entries:
+      find.find_file(entry, True)
+  def warm():
+    for entry in entries:
+      find.find_file(entry, True)
+  results = {"find_file cold": timed(cold, 3) / len(entries)}
+  results["find_file warm"] = timed(warm) / len(entries)
+  return results
+
+def bench_data(tmp, entries):
+  data_dir = os.path.join(tmp, "data")
+  os.makedirs(data_dir, exist_ok=True)
+  os.environ["PLAY_EPISODE_DATA"] = data_dir
+  data.base_dir = data_dir
+  data.cache_path = os.path.join(data_dir, "bench.cache")
+  with open(os.path.join(data_dir, data.file_name), "w") as f:
+    f.write("".join(data._format_line(e) for e in entries))
+  def parse():
+    if os.path.exists(data.cache_path):
+      os.remove(data.cache_path)
+    data.Data().get_data()
+  results = {"get_data parse": timed(parse)}
+  results["get_data cached"] = timed(lambda: data.Data().get_data())
+  loaded = data.Data()
+  loaded.get_data()
+  def save():
+    loaded.change_episode(0, 1)
+    loaded.save_data()
+  results["save_data"] = timed(save, 20)
+  loaded.wait_compaction()
+  return results
+
+def run(sizes, layouts):
+  """Runs the benchmarks.
+
+  Args:
+    sizes: A list of tuples (number of series, episodes per series).
+    layouts: A list of layouts, as in generate_library().
+
+  Returns:
+    A dictionary mapping "layout size metric" to a time in seconds.
+  """
+  results = {}
+  for layout in layouts:
+    for (n_series, n_episodes) in sizes:
+      tmp = tempfile.mkdtemp(prefix="play_episode_bench")
+      try:
+        entries = generate_library(os.path.join(tmp, "library"),
+                                   n_series, n_episodes, layout)
+        size = "{}x{}".format(n_series, n_episodes)
+        timings = bench_find(tmp, entries)
+        timings.update(bench_data(tmp, entries))
+        for metric, seconds in timings.items():
+          results["{} {} {}".format(layout, size, metric)] = seconds
+      finally:
+        shutil.rmtree(tmp)
+  return results
+
+def print_table(results, baseline = None):
+  for key, seconds in results.items():
+    line = "{:<40} {:10.3f} ms".format(key, seconds * 1000)
+    if baseline != None and key in baseline:
+      line += "  {:+7.1f}%".format((seconds / baseline[key] - 1) * 100)
+    print(line)
+
+def regressions(results, baseline, threshold):
+  """Returns the keys whose time exceeds "threshold" times the baseline."""
+  return [key for key, seconds in results.items()
+          if key in baseline and seconds > baseline[key] * threshold]
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--sizes", default="10x24,100x24,100x240",
+                      help="comma separated SERIESxEPISODES sizes")
+  parser.add_argument("--layouts", default="nested,flat",
+                      help="comma separated layouts (nested, flat)")
+  parser.add_argument("--save", help="save the results in this file")
+  parser.add_argument("--compare", help="compare with the results saved "
+                                        "in this file")
+  parser.add_argument("--threshold", type=float, default=1.25,
+                      help="maximum allowed ratio to the compared results")
+  args = parser.parse_args()
+  sizes = [tuple(int(n) for n in size.split("x"))
+           for size in args.sizes.split(",")]
+  results = run(sizes, args.layouts.split(","))
+  baseline = None
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+  print_table(results, baseline)
+  if args.save:
+    with open(args.save, "w") as f:
+      json.dump(results, f, indent=2)
+  if baseline != None:
+    slower = regressions(results, baseline, args.threshold)
+    for key in slower:
+      print("Regression: {}".format(key), file=sys.stderr)
+    sys.exit(1 if slower else 0)
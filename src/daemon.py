@@ -0,0 +1,450 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import json
+import errno
+import socket
+import threading
+import data
+import find
+
+class DaemonError(Exception):
+  """Raised by a client when the daemon can't serve a request."""
+  pass
+
+class Library:
+  """The state kept by the daemon: the series data and the episode index.
+
+  Requests are dictionaries decoded from JSON, naming an operation in
+  "op"; entries are passed as lists [name, season, episode, path] and are
+  found again by name and path, so that a client holding an outdated
+  list still changes the right entry. Requests changing the data are
+  served one at a time, under "lock", and saved before the reply, so that
+  clients in different terminals never overwrite each other's changes.
+  Lookups on disk are made without holding "lock", so that a slow or dead
+  directory blocks only the clients waiting for it.
+
+  Operations:
+    list: Returns {"entries": [entry, ...]}.
+    resolve: Looks up "entry", as find.find_file() with find_subs set to
+             "subs"; returns {"video": path, "subtitle": path or null}.
+    step: Finds the episode "step" files away from the one of "entry", as
+          find.step_episode() with "cached"; returns {"episode": [season,
+          episode] or null}.
+    next: Moves "entry" "step" (default 1) episodes, as in
+          data.Data.step_episode() with "cached"; returns {"entry": entry}.
+    watched: Marks the episode of "entry" as watched, moving to the one
+             after it; returns {"entry": entry}.
+    set: Sets "season" and "episode" of "entry"; returns {"entry": entry}.
+    change: Changes the episode of "entry" by "shift", as in
+            data.Data.change_episode(); returns {"entry": entry}.
+    add: Adds an entry from "name", "season", "episode" and "path";
+         returns {"entry": entry}.
+    delete: Deletes "entry"; returns {}.
+
+  On failure, the reply is {"error": message, "type": name of the
+  exception}, with the "errno" and "filename" of an OSError.
+  """
+  def __init__(self, entries):
+    self.entries = entries
+    self.lock = threading.Lock()
+
+  def handle(self, request):
+    """Serves a request, returning the reply."""
+    try:
+      op = getattr(self, "_op_" + str(request.get("op")), None)
+      if op == None:
+        raise ValueError("unknown operation")
+      if op in (self._op_resolve, self._op_step, self._op_next,
+                self._op_watched):
+        #lookups may be slow: these take the lock only to change the data
+        return op(request)
+      with self.lock:
+        return op(request)
+    except OSError as e:
+      return {"error": e.strerror or str(e), "type": "OSError",
+              "errno": e.errno, "filename": e.filename}
+    except (LookupError, ValueError, TypeError, AttributeError,
+            find.NotFoundError) as e:
+      return {"error": str(e), "type": type(e).__name__}
+
+  def _op_list(self, request):
+    return {"entries": [_dump(entry) for entry in self.entries]}
+
+  def _op_resolve(self, request):
+    found = find.find_file(_load(request["entry"]), True)
+    if not request.get("subs"):
+      return {"video": found[0]}
+    return {"video": found[0], "subtitle": found[1]}
+
+  def _op_step(self, request):
+    found = find.step_episode(_load(request["entry"]),
+                              int(request.get("step", 1)),
+                              bool(request.get("cached")))
+    return {"episode": list(found) if found != None else None}
+
+  def _op_next(self, request):
+    return self._step(request, int(request.get("step", 1)),
+                      bool(request.get("cached")))
+
+  def _op_watched(self, request):
+    (name, season, episode, path) = request["entry"]
+    return self._step(request, 1, False, (int(season), int(episode)))
+
+  def _step(self, request, step, cached, start = None):
+    """Moves an entry "step" episodes on disk, from the episode "start" if
+    given, from its current one otherwise.
+
+    The directory is looked up without holding "lock"; if the entry is
+    changed by another client meanwhile, it's looked up again.
+    """
+    while True:
+      with self.lock:
+        entry = self.entries[self._index(request)]
+        current = (entry.season, entry.episode)
+      (season, episode) = start if start != None else current
+      try:
+        found = find.step_episode(data.Entry(entry.name, season, episode,
+                                             entry.path), step, cached)
+      except OSError:
+        found = None
+      with self.lock:
+        i = self._index(request)
+        entry = self.entries[i]
+        if start == None and (entry.season, entry.episode) != current:
+          continue
+        self.entries.set_episode(i, season, episode)
+        if found == None:
+          self.entries.change_episode(i, step)
+        else:
+          self.entries.set_episode(i, *found)
+        return self._save(i)
+
+  def _op_set(self, request):
+    i = self._index(request)
+    self.entries.set_episode(i, int(request["season"]),
+                             int(request["episode"]))
+    return self._save(i)
+
+  def _op_change(self, request):
+    i = self._index(request)
+    self.entries.change_episode(i, int(request["shift"]))
+    return self._save(i)
+
+  def _op_add(self, request):
+    (name, path) = (str(request["name"]), str(request["path"]))
+    self.entries.add_entry(name, int(request["season"]),
+                           int(request["episode"]), path)
+    return self._save(self.entries.index_of(name, path))
+
+  def _op_delete(self, request):
+    self.entries.delete_entry(self._index(request))
+    self.entries.save_data()
+    return {}
+
+  def _index(self, request):
+    (name, season, episode, path) = request["entry"]
+    i = self.entries.index_of(name, path)
+    if i == -1:
+      raise LookupError("no such entry")
+    return i
+
+  def _save(self, index):
+    self.entries.save_data()
+    return {"entry": _dump(self.entries[index])}
+
+def serve(path = None, entries = None):
+  """Runs the daemon, until it's interrupted or terminated.
+
+  The episode index is warmed up with the directories of all the entries,
+  kept up to date with a watch.Watcher where inotify is available, and
+  the library is scanned as by main.py if "PLAY_EPISODE_ROOTS" is set.
+
+  Args:
+    path: Optional. The path of the socket. Default value: as returned by
+          data.get_socket_path().
+    entries: Optional. The series data, not loaded yet. Default value:
+             as returned by data.open_data().
+
+  Raises:
+    OSError: The socket couldn't be created, or another daemon is running
+  """
+  import signal
+  import socketserver
+  import watch
+  if path == None:
+    path = data.get_socket_path()
+  if entries == None:
+    entries = data.open_data()
+  entries.get_data()
+  library = Library(entries)
+
+  class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+      for line in self.rfile:
+        try:
+          request = json.loads(line)
+          if not isinstance(request, dict):
+            raise ValueError
+        except ValueError:
+          reply = {"error": "invalid request", "type": "ValueError"}
+        else:
+          reply = library.handle(request)
+        self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+  class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+  _remove_stale(path)
+  data._assure_dir(os.path.dirname(os.path.abspath(path)))
+  old_umask = os.umask(0o077)
+  try:
+    server = Server(path, Handler)
+  finally:
+    os.umask(old_umask)
+  def stop(signum, frame):
+    threading.Thread(target=server.shutdown, daemon=True).start()
+  signal.signal(signal.SIGTERM, stop)
+  try:
+    watch.start()
+    threading.Thread(target=find.find_files, args=(list(entries),),
+                     daemon=True).start()
+    if os.environ.get("PLAY_EPISODE_ROOTS"):
+      import library as library_scan
+      threading.Thread(target=library_scan.scan,
+                       args=(library_scan.get_roots(),), daemon=True).start()
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    os.unlink(path)
+    with library.lock:
+      entries.wait_compaction()
+      entries.save_cache()
+
+def _remove_stale(path):
+  """Removes the socket left by a daemon that didn't exit cleanly."""
+  probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    probe.connect(path)
+  except FileNotFoundError:
+    return
+  except ConnectionRefusedError:
+    os.unlink(path)
+    return
+  finally:
+    probe.close()
+  raise OSError(errno.EADDRINUSE, "a daemon is already running", path)
+
+class Client:
+  """A connection to the daemon.
+
+  A client can be used by one thread at a time.
+  """
+  def __init__(self, path = None):
+    """Connects to the daemon.
+
+    Raises:
+      OSError: No daemon is listening on the socket
+    """
+    if path == None:
+      path = data.get_socket_path()
+    self.path = path
+    self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      self.socket.connect(path)
+    except OSError:
+      self.socket.close()
+      raise
+    self.file = self.socket.makefile("rwb")
+
+  def request(self, op, **args):
+    """Sends a request to the daemon and returns the reply.
+
+    Args:
+      op: The operation, as in Library.
+      **args: The arguments of the operation.
+
+    Raises:
+      find.NotFoundError: The episode to resolve wasn't found
+      DaemonError: The daemon couldn't serve the request
+      OSError: The connection was lost, or the daemon couldn't access a
+               directory
+    """
+    args["op"] = op
+    self.file.write(json.dumps(args).encode() + b"\n")
+    self.file.flush()
+    line = self.file.readline()
+    if not line:
+      raise OSError(errno.ECONNRESET, "the daemon closed the connection")
+    reply = json.loads(line)
+    if "error" in reply:
+      if reply.get("type") == "NotFoundError":
+        raise find.NotFoundError
+      if reply.get("type") == "OSError":
+        raise OSError(reply.get("errno"), reply["error"],
+                      reply.get("filename"))
+      raise DaemonError(reply["error"])
+    return reply
+
+  def close(self):
+    self.file.close()
+    self.socket.close()
+
+class RemoteData(list):
+  """The series data, kept by the daemon.
+
+  Offers the same interface as data.Data, so that main.py can use it in
+  its place: the list is read from the daemon by get_data(), and every
+  change is sent to the daemon, which saves it at once, and applied to the
+  local copy. Episodes are looked up by the daemon too, through "finder".
+  If another client deleted the entry being changed, the list is read
+  again and data.EntriesChanged is raised.
+
+  Attributes:
+    client: The Client connected to the daemon.
+    finder: A RemoteFinder sharing "client" in this thread.
+  """
+  def __init__(self, client):
+    list.__init__(self)
+    self.client = client
+    self.finder = RemoteFinder(client)
+    self.path = None
+
+  def get_data(self):
+    """Reads the list of series from the daemon."""
+    self[:] = [_load(e) for e in self.client.request("list")["entries"]]
+
+  def save_data(self):
+    """Present for compatibility with data.Data; the daemon saves every
+    change as soon as it's made."""
+    pass
+
+  def wait_compaction(self):
+    """Present for compatibility with data.Data."""
+    pass
+
+  def save_cache(self):
+    """Present for compatibility with data.Data."""
+    pass
+
+  def change_path(self, new_path):
+    self.path = new_path
+
+  def add_entry(self, name, season, episode, path = None):
+    if path == None:
+      path = os.path.abspath(os.curdir)
+    self.client.request("add", name=name, season=season, episode=episode,
+                        path=path)
+    #entries added by other clients are read as well
+    self.get_data()
+
+  def delete_entry(self, index):
+    try:
+      self.client.request("delete", entry=_dump(self[index]))
+    except DaemonError:
+      #already deleted by another client
+      self.get_data()
+      return
+    del self[index]
+
+  def change_episode(self, index, shift):
+    self._change("change", index, shift=shift)
+
+  def set_episode(self, index, season, episode):
+    self._change("set", index, season=season, episode=episode)
+
+  def step_episode(self, index, step, cached = False):
+    self._change("next", index, step=step, cached=cached)
+
+  def mark_watched(self, index):
+    """Moves an entry past its current episode, as after playing it."""
+    self._change("watched", index)
+
+  def index_of(self, name, path):
+    for (i, entry) in enumerate(self):
+      if entry.name == name and entry.path == path:
+        return i
+    return -1
+
+  def find_file(self, entry, find_subs = False):
+    """Finds the path of an episode, as find.find_file()."""
+    return self.finder.find_file(entry, find_subs)
+
+  def _change(self, op, index, **args):
+    try:
+      reply = self.client.request(op, entry=_dump(self[index]), **args)
+    except DaemonError:
+      #the entry was deleted by another client
+      self.get_data()
+      raise data.EntriesChanged
+    self[index] = _load(reply["entry"])
+
+class RemoteFinder:
+  """Looks up episodes in the daemon, with the interface of the find
+  module, so that it can be used in its place.
+
+  It can be used by any thread: each thread other than the one creating
+  it opens its own connection to the daemon, so that a lookup waiting for
+  a slow directory doesn't hold up the others.
+  """
+  def __init__(self, client):
+    self.path = client.path
+    self._local = threading.local()
+    self._local.client = client
+
+  def find_file(self, entry, find_subs = False, save = True):
+    """As find.find_file(); the daemon saves its own index, so "save" is
+    ignored."""
+    reply = self._client().request("resolve", entry=_dump(entry),
+                                   subs=find_subs)
+    if find_subs:
+      return (reply["video"], reply["subtitle"])
+    return reply["video"]
+
+  def step_episode(self, entry, step, cached = False):
+    """As find.step_episode()."""
+    found = self._client().request("step", entry=_dump(entry), step=step,
+                                   cached=cached)["episode"]
+    return tuple(found) if found != None else None
+
+  def _client(self):
+    client = getattr(self._local, "client", None)
+    if client == None:
+      client = self._local.client = Client(self.path)
+    return client
+
+def connect(path = None):
+  """Returns a RemoteData connected to the daemon, or None if it isn't
+  running."""
+  try:
+    return RemoteData(Client(path))
+  except OSError:
+    return None
+
+def _dump(entry):
+  return [entry.name, entry.season, entry.episode, entry.path]
+
+def _load(fields):
+  (name, season, episode, path) = fields
+  return data.Entry(str(name), int(season), int(episode), str(path))
+
+if __name__ == "__main__":
+  #runs the daemon; with "list", prints the series and their next
+  #episode as a client
+  if sys.argv[1:] == ["list"]:
+    entries = connect()
+    if entries == None:
+      sys.exit("the daemon isn't running")
+    entries.get_data()
+    for entry in entries:
+      try:
+        video = entries.find_file(entry)
+      except (find.NotFoundError, OSError):
+        video = None
+      print("{} - {:02d}x{:02d}: {}".format(entry.name, entry.season,
+                                            entry.episode, video))
+  else:
+    serve()
@@ -1,17 +1,81 @@
 #! /usr/bin/env python3
 
-import re
 import os
 import errno
+import bisect
+import pickle
+import threading
+import tracing
 
 file_name = "play_episode.data"
 base_dir = os.path.join(os.path.expanduser("~"),".play_episode") 
+cache_path = os.path.join(base_dir, "play_episode.cache")
+socket_var = "PLAY_EPISODE_SOCKET"
+socket_name = "play_episode.sock"
 
 class RangeError(Exception):
   pass
 
+class EntriesChanged(Exception):
+  """Raised when an entry can't be changed because another program deleted
+  it; the entries have been read again."""
+  pass
+
+class Entry:
+  """A series being watched.
+
+  Attributes:
+    name: The name of the series.
+    season: The number of the season of the current episode.
+    episode: The number of the current episode.
+    path: The directory where the episodes are stored.
+  """
+  __slots__ = ("name", "season", "episode", "path")
+
+  def __init__(self, name, season, episode, path):
+    self.name = name
+    self.season = season
+    self.episode = episode
+    self.path = path
+
+  def __eq__(self, other):
+    if not isinstance(other, Entry):
+      return NotImplemented
+    return (self.name, self.season, self.episode, self.path) ==\
+           (other.name, other.season, other.episode, other.path)
+
+  def __repr__(self):
+    return "Entry({!r}, {!r}, {!r}, {!r})".format(self.name, self.season,
+                                                  self.episode, self.path)
+
+  def sort_key(self):
+    return self.name.lower()
+
 class Data(list):
-  
+  """The series being watched, with the last episode watched of each.
+
+  The data is stored in a snapshot file, with an entry per line, and a
+  journal next to it: every change is appended to the journal when saved,
+  so that saving doesn't rewrite the whole file. When the journal grows
+  longer than "compact_after" records, it's folded in a new snapshot in
+  the background; the snapshot is written to a temporary file and renamed,
+  so that a crash never leaves a truncated file behind.
+
+  Attributes:
+    path: The path of the snapshot file.
+    pending: The journal records not saved yet.
+  """
+
+  compact_after = 100
+
+  def __init__(self, *args):
+    list.__init__(self, *args)
+    self.pending = []
+    self._journaled = None
+    self._records = 0
+    self._compactor = None
+
+  @tracing.traced("data.get_data")
   def get_data(self):
     """Get the data about series already saved in the config file.
 
@@ -21,24 +85,30 @@ class Data(list):
     user; the one in the variable "base_dir".
     If no suitable file is found, it creates a new one in "base_dir".
     The loaded file (or the newly created) is set as the default
-    file by setting the variable "path"
+    file by setting the variable "path". Any change in the journal of the
+    file is applied to the loaded data, skipping the records a crash left
+    incomplete or unreadable. If the file and its journal didn't
+    change since the last call to save_cache(), the data is loaded from
+    the snapshot saved there instead.
 
-    Returns:
-      A list of dictionaries; each element of the list is a dictionary of 4
-      elements, {name, season, episode, path}
+    Each line of the file is loaded as an Entry; entries are kept sorted by
+    name.
 
     Raises:
       IOError: No suitable file was found, and a new file couldn't be
       created
     """ 
     del self[:]
+    del self.pending[:]
     for loc in os.environ.get("PLAY_EPISODE_DATA"), os.curdir,\
                os.path.expanduser("~"), base_dir:
       try:
-        with open(os.path.join(loc,file_name), "rU") as f:
+        with open(os.path.join(loc,file_name), "r") as f:
+          self.path = os.path.join(loc,file_name)       
+          if self._load_cache():
+            return
           for line in f:
             self.append(_parse_line(line))
-          self.path = os.path.join(loc,file_name)       
           break
       except IOError:
         pass
@@ -48,31 +118,122 @@ class Data(list):
       _assure_dir(base_dir)
       with open(os.path.join(base_dir,file_name), "w"):
         pass
+      self.path = os.path.join(base_dir,file_name)
+    self.sort(key=Entry.sort_key)
+    self._journaled = self.path
+    self._records = 0
+    for journal in self._journal() + ".old", self._journal():
+      try:
+        with open(journal, "r") as f:
+          for line in f:
+            #a record cut short by a crash doesn't end with "|\n"
+            if not line.endswith("|\n"):
+              if not line.endswith("\n"):
+                _cut_torn_record(journal)
+              continue
+            try:
+              self._apply(line)
+            except ValueError:
+              continue
+            self._records += 1
+      except IOError:
+        pass
+    self.save_cache()
+
+  def save_cache(self):
+    """Saves a snapshot of the data, to speed up the next get_data().
+
+    The snapshot is used only as long as the data file and its journal
+    don't change. Nothing is saved while there are changes not saved with
+    save_data(), or while a compaction is running.
+    """
+    if self.pending or (self._compactor != None and
+                        self._compactor.is_alive()):
+      return
+    try:
+      _assure_dir(base_dir)
+      tmp_path = cache_path + ".tmp"
+      with open(tmp_path, "wb") as f:
+        #stored by column, which is much faster to load than Entry objects
+        columns = tuple(tuple(getattr(e, attr) for e in self)
+                        for attr in Entry.__slots__)
+        pickle.dump((self.path, self._signature(), self._records, columns),
+                    f, pickle.HIGHEST_PROTOCOL)
+      os.replace(tmp_path, cache_path)
+    except (IOError, OSError):
+      pass
+
+  def _load_cache(self):
+    try:
+      with open(cache_path, "rb") as f:
+        (path, signature, records, columns) = pickle.load(f)
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+      return False
+    if path != self.path or signature != self._signature():
+      return False
+    self[:] = map(Entry, *columns)
+    self._journaled = self.path
+    self._records = records
+    return True
 
+  def _signature(self):
+    signature = []
+    for path in self.path, self._journal() + ".old", self._journal():
+      try:
+        st = os.stat(path)
+        signature.append((st.st_ino, st.st_size, st.st_mtime_ns))
+      except OSError:
+        signature.append(None)
+    return tuple(signature)
+
+  @tracing.traced("data.save_data")
   def save_data(self):
     """Saves the current series data
 
-    This function saves the current data to the file specified in "path".
+    This function appends the changes made since the last save to the
+    journal of the file specified in "path", and waits for them to be
+    written to the disk. If "path" was changed, the whole data is written
+    to the new file instead.
 
     Raises:
       IOError: The file where to save the data in couldn't be opened
     """ 
-    with open(self.path, "w") as f:
-      for elem in self:
-        for key in ("name","season","episode","path"): 
-          f.write("{}|".format(elem[key]))
-        f.write("\n")
-
-  def add_entry(self, name, season, episode):
-    conv_str = lambda x: str(x) if x >= 10 else "0" + str(x)
-    season = conv_str(season)
-    episode = conv_str(episode)
-    self.append({"name":name, "season":season, "episode":episode,\
-                 "path":os.path.abspath(os.curdir)})
-    comp_fun = lambda x: x["name"].lower()
-    self.sort(key=comp_fun)
+    if self.path != self._journaled:
+      self.wait_compaction()
+      _write_snapshot(self.path, [_format_line(e) for e in self])
+      for journal in self._journal() + ".old", self._journal():
+        if os.path.exists(journal):
+          os.remove(journal)
+      self._journaled = self.path
+      self._records = 0
+      del self.pending[:]
+      return
+    if self.pending:
+      with open(self._journal(), "a") as f:
+        f.write("".join(self.pending))
+        f.flush()
+        os.fsync(f.fileno())
+      self._records += len(self.pending)
+      del self.pending[:]
+    if self._records > self.compact_after:
+      self._start_compaction()
+
+  def wait_compaction(self):
+    """Waits for a compaction running in the background to end."""
+    if self._compactor != None:
+      self._compactor.join()
+      self._compactor = None
+
+  def add_entry(self, name, season, episode, path = None):
+    if path == None:
+      path = os.path.abspath(os.curdir)
+    entry = Entry(name, season, episode, path)
+    self._upsert(entry)
+    self.pending.append("S|" + _format_line(entry))
 
   def delete_entry(self, index):
+    self.pending.append("D|{}|{}|\n".format(self[index].name,
+                                            self[index].path))
     del(self[index])
     
 
@@ -96,14 +257,228 @@ class Data(list):
       RangeError: No entry with the given index was found
     """
 
-    val = int(self[index]["episode"])
-    val = max(min(val+shift, 99),0)
-    self[index]["episode"] = "{0:02d}".format(val)
+    entry = self[index]
+    entry.episode = max(min(entry.episode+shift, 99),0)
+    self.pending.append("S|" + _format_line(self[index]))
+
+  def set_episode(self, index, season, episode):
+    """Sets the season and the episode of an entry.
+
+    Args:
+      index: The index of the entry to change
+      season: The new season
+      episode: The new episode
+
+    Raises:
+      IndexError: No entry with the given index was found
+    """
+    entry = self[index]
+    (entry.season, entry.episode) = (season, episode)
+    self.pending.append("S|" + _format_line(entry))
+
+  def step_episode(self, index, step, cached = False):
+    """Moves an entry to the episode "step" files away on disk.
+
+    Seasons are crossed as needed, as in find.step_episode(); if there's
+    no such episode, or the directory can't be read, the episode number is
+    just changed by "step".
+
+    Args:
+      index: The index of the entry to change
+      step: The number of episodes to move, negative to move back
+      cached: Optional. As in find.step_episode().
+    """
+    _step_episode(self, index, step, cached)
+
+  def index_of(self, name, path):
+    """Returns the index of the entry with a name and a path, or -1."""
+    return self._find(name, path)
+
+  def _journal(self):
+    return self.path + ".journal"
+
+  def _find(self, name, path):
+    key = name.lower()
+    i = bisect.bisect_left(self, key, key=Entry.sort_key)
+    while i < len(self) and self[i].sort_key() == key:
+      if self[i].name == name and self[i].path == path:
+        return i
+      i += 1
+    return -1
+
+  def _upsert(self, entry):
+    i = self._find(entry.name, entry.path)
+    if i == -1:
+      bisect.insort(self, entry, key=Entry.sort_key)
+    else:
+      self[i] = entry
+
+  def _apply(self, line):
+    """Applies a journal record to the data.
+
+    Records are idempotent, so the journal can be applied again on top of
+    a snapshot already containing it.
+    """
+    (op, rest) = line.split("|", 1)
+    if op == "S":
+      self._upsert(_parse_line(rest))
+    elif op == "D":
+      (name, path) = rest.split("|")[:2]
+      i = self._find(name, path)
+      if i != -1:
+        del self[i]
+
+  def _start_compaction(self):
+    if self._compactor != None and self._compactor.is_alive():
+      return
+    journal = self._journal()
+    old = journal + ".old"
+    if os.path.exists(old):
+      #a previous compaction didn't finish: keep its records together
+      with open(journal, "r") as src, open(old, "a") as dst:
+        dst.write(src.read())
+        dst.flush()
+        os.fsync(dst.fileno())
+      os.remove(journal)
+    else:
+      os.replace(journal, old)
+    _fsync_dir(os.path.dirname(journal))
+    self._records = 0
+    lines = [_format_line(e) for e in self]
+    self._compactor = threading.Thread(target=_compact,
+                                       args=(self.path, lines, old))
+    self._compactor.start()
+
+class PickledCache(dict):
+  """A dictionary saved to a file with pickle, shared between threads.
+
+  The file holds a tuple (version, contents): a file saved with another
+  "version", or that can't be read, leaves the cache empty. Subclasses set
+  "name" and "version", and load and save the cache with read() and
+  write().
+
+  Attributes:
+    path: The file where the cache is saved.
+    lock: The lock held while the cache is changed, loaded or saved.
+  """
+  #The default file name in "base_dir", and the version of its format
+  name = None
+  version = None
+
+  def __init__(self, path = None):
+    dict.__init__(self)
+    if path == None:
+      path = os.path.join(base_dir, self.name)
+    self.path = path
+    self.lock = threading.RLock()
+
+  def read(self):
+    """Loads the cache saved in "path", if it can be read."""
+    with self.lock:
+      self.clear()
+      try:
+        with open(self.path, "rb") as f:
+          (version, cached) = pickle.load(f)
+        if version == self.version:
+          self.update(cached)
+      except (IOError, EOFError, ValueError, TypeError,
+              pickle.UnpicklingError):
+        pass
+
+  def write(self):
+    """Saves the cache to "path".
+
+    The cache is written to a temporary file first, and then renamed, so
+    that a crash never leaves a truncated file behind.
+
+    Raises:
+      IOError: The cache couldn't be saved
+    """
+    with self.lock:
+      _assure_dir(os.path.dirname(self.path))
+      tmp_path = self.path + ".tmp"
+      with open(tmp_path, "wb") as f:
+        pickle.dump((self.version, dict(self)), f, pickle.HIGHEST_PROTOCOL)
+      os.replace(tmp_path, self.path)
+
+def get_socket_path():
+  """Returns the path of the socket of the daemon (see daemon.py).
+
+  It's read from the environment variable "PLAY_EPISODE_SOCKET" if set,
+  otherwise it's "socket_name" in "base_dir".
+  """
+  return os.environ.get(socket_var, os.path.join(base_dir, socket_name))
+
+def open_data():
+  """Returns the series data, not loaded yet.
+
+  The backend is chosen by the environment variable
+  "PLAY_EPISODE_BACKEND": a sqlite_data.SqliteData if it's "sqlite", a
+  Data otherwise.
+  """
+  if os.environ.get("PLAY_EPISODE_BACKEND") == "sqlite":
+    from sqlite_data import SqliteData
+    return SqliteData()
+  return Data()
+
+def _step_episode(entries, index, step, cached):
+  import find
+  try:
+    found = find.step_episode(entries[index], step, cached)
+  except OSError:
+    found = None
+  if found == None:
+    entries.change_episode(index, step)
+  else:
+    entries.set_episode(index, *found)
+
+def _compact(path, lines, old_journal):
+  try:
+    _write_snapshot(path, lines)
+    os.remove(old_journal)
+  except (IOError, OSError):
+    #the old journal is applied again at the next load
+    pass
+
+def _cut_torn_record(journal):
+  """Removes the incomplete last line of a journal, so that the next
+  record isn't appended to it."""
+  try:
+    with open(journal, "r+b") as f:
+      content = f.read()
+      f.truncate(content.rfind(b"\n") + 1)
+  except (IOError, OSError):
+    pass
+
+def _write_snapshot(path, lines):
+  tmp_path = path + ".tmp"
+  with open(tmp_path, "w") as f:
+    f.write("".join(lines))
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp_path, path)
+  _fsync_dir(os.path.dirname(path))
+
+def _fsync_dir(directory):
+  try:
+    fd = os.open(directory or os.curdir, os.O_RDONLY)
+  except OSError:
+    return
+  try:
+    os.fsync(fd)
+  except OSError:
+    pass
+  finally:
+    os.close(fd)
+
+def _format_line(entry):
+  return "{}|{:02d}|{:02d}|{}|\n".format(entry.name, entry.season,
+                                        entry.episode, entry.path)
 
 def _parse_line(line):
-  (name,season,episode,path) = \
-    re.search(r"(.*?)\|(\d*?)\|(\d*?)\|(.*)\|", line).groups()
-  return {"name":name, "season":season, "episode":episode, "path":path}
+  (name,season,episode,path) = line.rstrip("\r\n").split("|", 3)
+  #the path can contain "|", and is followed by a last one
+  return Entry(name, int(season or 0), int(episode or 0), path[:-1])
 
 
 def _assure_dir(directory):
@@ -122,7 +497,7 @@ def _assure_dir(directory):
   try:
     os.makedirs(directory)
   except OSError as exception:
-    if exception.errno != errno.EEXIST or not os.path.isdir(base_dir):
+    if exception.errno != errno.EEXIST or not os.path.isdir(directory):
       raise
   
 
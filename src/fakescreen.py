@@ -0,0 +1,164 @@
+#! /usr/bin/env python3
+
+import curses
+import time
+import collections
+
+#A key that isn't pressed in time: the pending read fails as with halfdelay
+TIMEOUT = object()
+
+class ReplayEnd(Exception):
+  """Raised when a key is read after the last one of the script"""
+  pass
+
+Keystroke = collections.namedtuple("Keystroke",
+                                   ["key", "seconds", "cells", "bytes"])
+
+class FakeScreen:
+  """A backend for interface.use_backend() drawing on a grid in memory.
+
+  Keys are read from a script instead of the keyboard. For each key, the
+  time spent before the next key is read, the cells written by addstr()
+  and an estimate of the bytes a terminal would receive are recorded:
+  the estimate counts the bytes of the cells that changed on the screen
+  at each refresh, plus a cursor movement for each run of changed cells.
+
+  Attributes:
+    LINES: The number of lines of the screen.
+    COLS: The number of columns of the screen.
+    cells: The content of the screen, a list of lists of characters.
+    keystrokes: The Keystroke recorded for each key read.
+  """
+  A_BOLD = curses.A_BOLD
+  A_REVERSE = curses.A_REVERSE
+  error = curses.error
+  cursor_move = 6
+
+  def __init__(self, keys = (), lines = 24, cols = 80):
+    self.LINES = lines
+    self.COLS = cols
+    self.cells = [[(" ", 0)] * cols for _ in range(lines)]
+    self.keys = collections.deque(keys)
+    self.keystrokes = []
+    self._current = None
+    self._cells = 0
+    self._bytes = 0
+
+  def finish(self):
+    """Records the last key read, whose handling is over."""
+    if self._current != None:
+      (key, start) = self._current
+      self.keystrokes.append(Keystroke(key, time.perf_counter() - start,
+                                       self._cells, self._bytes))
+      self._current = None
+
+  def _read_key(self):
+    self.finish()
+    if not self.keys:
+      raise ReplayEnd
+    key = self.keys.popleft()
+    if key is TIMEOUT:
+      raise curses.error("no input")
+    self._cells = self._bytes = 0
+    self._current = (key, time.perf_counter())
+    return key
+
+  def _refresh(self, window):
+    runs = 0
+    for row in range(window.rows):
+      y = window.y + row
+      if not 0 <= y < self.LINES:
+        continue
+      in_run = False
+      for col in range(window.cols):
+        x = window.x + col
+        if not 0 <= x < self.COLS:
+          continue
+        cell = window.cells[row][col]
+        if self.cells[y][x] != cell:
+          self.cells[y][x] = cell
+          self._bytes += len(cell[0].encode())
+          if not in_run:
+            runs += 1
+          in_run = True
+        else:
+          in_run = False
+    self._bytes += runs * self.cursor_move
+
+  def text(self):
+    """Returns the content of the screen, a string per line."""
+    return ["".join(c for c, _ in line).rstrip() for line in self.cells]
+
+  def initscr(self):
+    return FakeWindow(self, self.LINES, self.COLS, 0, 0)
+
+  def newwin(self, rows, cols, y, x):
+    return FakeWindow(self, rows, cols, y, x)
+
+  def noecho(self):
+    pass
+
+  def echo(self):
+    pass
+
+  def cbreak(self):
+    pass
+
+  def nocbreak(self):
+    pass
+
+  def curs_set(self, visibility):
+    pass
+
+  def endwin(self):
+    pass
+
+class FakeWindow:
+  """A window of a FakeScreen, offering the methods of a curses window."""
+  def __init__(self, screen, rows, cols, y, x):
+    self.screen = screen
+    self.rows, self.cols, self.y, self.x = rows, cols, y, x
+    self.cells = [[(" ", 0)] * cols for _ in range(rows)]
+    self.cursor = (0, 0)
+
+  def addstr(self, *args):
+    if len(args) >= 3:
+      (y, x, string) = args[:3]
+      attr = args[3] if len(args) > 3 else 0
+    else:
+      (y, x) = self.cursor
+      string = args[0]
+      attr = args[1] if len(args) > 1 else 0
+    for char in string:
+      if char == "\n":
+        (y, x) = (y + 1, 0)
+      elif y >= self.rows or x >= self.cols:
+        raise curses.error("addstr() returned ERR")
+      else:
+        self.cells[y][x] = (char, attr)
+        self.screen._cells += 1
+        x += 1
+        if x == self.cols:
+          (y, x) = (y + 1, 0)
+      if y >= self.rows:
+        raise curses.error("addstr() returned ERR")
+    self.cursor = (y, x)
+
+  def clear(self):
+    self.cells = [[(" ", 0)] * self.cols for _ in range(self.rows)]
+    self.cursor = (0, 0)
+
+  def refresh(self):
+    self.screen._refresh(self)
+
+  def getkey(self, *args):
+    return self.screen._read_key()
+
+  def getmaxyx(self):
+    return (self.rows, self.cols)
+
+  def keypad(self, flag):
+    pass
+
+  def nodelay(self, flag):
+    pass
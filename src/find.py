@@ -2,45 +2,408 @@
 
 import os
 import re
+import bisect
+import collections
 import data
+import search
+import tracing
 
 import sys
 
-set_extensions = set(("mkv","avi","mp4"))
+#Video extensions, most preferred first
+set_extensions = ("mkv", "mp4", "avi")
+subtitle_extensions = ("srt", "ass", "sub", "vtt")
+#Folders next to the videos holding their subtitles, lowercase
+subtitle_dirs = ("subs", "subtitles")
+languages_var = "PLAY_EPISODE_SUB_LANGS"
+default_languages = ("en", "eng", "english")
+index_name = "play_episode.index"
+index_version = 6
+
+#A run of digits followed by x/e and a second run of digits; the second
+#run isn't consumed, as it can be the season of the next marker
+_episode_expr = re.compile(r"(\d+)[xXeE](?=(\d+))")
+_tag_expr = re.compile(r"[^\W_]+")
+#The end of a multi-episode marker, as in "S01E01-E02", "S01E01E02" or
+#"1x01-02"
+_range_expr = re.compile(r"(?:-?[eE]|-)(\d+)")
+#The most episodes a single file is believed to hold
+max_span = 4
+
+Classified = collections.namedtuple("Classified",
+                                    ["season", "episode", "last",
+                                     "extension", "tags", "keys", "series"])
 
-class _FoundError(Exception):
-  pass
 class NotFoundError(Exception):
   """Raised in find_file if no file is found"""
   pass
 
-def gen_expr(season,episode,extension):
-  """Generates the regular expression for the file"""
-  return r".*0*{0}[xXeE]0*{1}[^0-9]+.*\.{2}$".format(int(season),
-                                              int(episode),
-                                              extension)
+class Index(data.PickledCache):
+  """Persistent index of the episodes found in a set of directories.
+
+  The index maps the path of a directory to a tuple (signature, episodes),
+  as returned by read_directory(). A directory is listed again only if its
+  mtime, or the one of its subtitle folders, changed since the last time
+  it was indexed.
+
+  The index can be shared between threads: loading and saving are
+  serialized by "lock", while single lookups and updates of a directory
+  are atomic.
+
+  Attributes:
+    path: The file where the index is saved.
+    lock: The lock held while the index is loaded or saved.
+    loaded: True once the index was loaded.
+    dirty: True if directories were read since the index was last saved.
+    watcher: An object whose watch() method is called with each directory
+             read, such as a watch.Watcher, or None.
+  """
+  name = index_name
+  version = index_version
+
+  def __init__(self, path = None):
+    data.PickledCache.__init__(self, path)
+    self.loaded = False
+    self.dirty = False
+    self.watcher = None
+
+  def get_index(self):
+    """Loads the index saved in "path".
+
+    If the file doesn't exist, can't be read or was saved by another
+    version, the index is left empty; it will be rebuilt as directories are
+    looked up.
+    """
+    with self.lock:
+      self.loaded = True
+      self.read()
+
+  def load(self):
+    """Loads the index, unless it was already loaded."""
+    if not self.loaded:
+      with self.lock:
+        if not self.loaded:
+          self.get_index()
+
+  def save_index(self):
+    """Saves the index to "path".
+
+    The index is written to a temporary file first, and then renamed, so
+    that a crash never leaves a truncated index behind.
+
+    Raises:
+      IOError: The index couldn't be saved
+    """
+    with self.lock:
+      #a directory read while saving marks the index dirty again
+      self.dirty = False
+      self.write()
+
+  def flush(self):
+    """Saves the index if it's dirty, ignoring errors: a directory that
+    isn't saved is listed again by the next program."""
+    if self.dirty:
+      try:
+        self.save_index()
+      except IOError:
+        pass
+
+  def episodes(self, directory, save = True):
+    """Returns the episodes found in "directory".
+
+    The directory is listed only if it wasn't indexed yet, or if it changed
+    since it was; otherwise, the cached episodes are returned.
+
+    Args:
+      directory: The path of the directory.
+      save: Optional. If False, the index is only marked dirty when the
+            directory is listed, so that a batch of lookups can save it
+            once with flush().
+
+    Raises:
+      OSError: The directory couldn't be accessed
+
+    Returns:
+      The episodes, as in index_directory().
+    """
+    self.load()
+    cached = self.get(directory)
+    if cached != None and _unchanged(directory, cached[0]):
+      return cached[1]
+    with tracing.span("find.index_directory", directory=directory):
+      (signature, episodes, subdirs) = read_directory(directory)
+    self[directory] = (signature, episodes)
+    self.dirty = True
+    if self.watcher != None:
+      self.watcher.watch(directory)
+    if save:
+      self.flush()
+    return episodes
+
+index = Index()
+
+def classify(name):
+  """Parses a file name into the episodes it could contain.
+
+  A name matches a (season, episode) tuple if it contains the season
+  number, optionally zero-padded, followed by one of "xXeE", the episode
+  number, optionally zero-padded, and at least one non-digit character
+  before the extension (e.g. "S01E02 - Title.mkv" or "1x02 Title.avi").
+  As any digit may precede the season, a name can match more than one
+  tuple: "S11E02.x.mkv" matches both (11, 2) and (1, 2). A file can hold
+  consecutive episodes, as in "S01E01-E02.x.mkv", matching each of them.
+
+  Args:
+    name: The name of the file.
+
+  Returns:
+    A Classified tuple: "season" and "episode" are the numbers of the
+    first episode marker in the name (None if there's none), "last" the
+    last episode held by the file (equal to "episode" unless the file
+    holds more than one), "extension"
+    is the extension of the file, "tags" a tuple of the lowercase words
+    after the last marker (e.g. ("720p", "eng")), "keys" the set of all
+    the (season, episode) tuples matched by the name and "series" the
+    text before the first marker, normalized by search.normalize() (e.g.
+    "theoffice" for "The.Office.S01E02.720p.mkv").
+  """
+  stem, dot, ext = name.rpartition(".")
+  if not dot:
+    return Classified(None, None, None, ext, (), frozenset(), "")
+  #at least one character must separate the episode from the extension
+  limit = len(stem) - 1
+  season = episode = last = None
+  keys = set()
+  end = 0
+  series = ""
+  for m in _episode_expr.finditer(stem):
+    if m.end(2) <= limit:
+      digits, ep = m.group(1), int(m.group(2))
+      if season == None:
+        (season, episode, last) = (int(digits), ep, ep)
+        series = _series_name(stem[:m.start()])
+      elif int(digits) == season and last < ep <= episode + max_span:
+        last = ep
+      #any suffix of the first run can be the season
+      for i in range(len(digits)):
+        keys.add((int(digits[i:]), ep))
+      end = m.end(2)
+      r = _range_expr.match(stem, end)
+      if r and r.end(1) <= limit and\
+         int(digits) == season and ep < int(r.group(1)) <= ep + max_span:
+        for i in range(len(digits)):
+          keys.update((int(digits[i:]), e)
+                      for e in range(ep + 1, int(r.group(1)) + 1))
+        last = max(last, int(r.group(1)))
+        end = r.end(1)
+  tags = tuple(_tag_expr.findall(stem[end:].lower())) if keys else ()
+  return Classified(season, episode, last, ext, tags, frozenset(keys),
+                    series)
+
+def _series_name(prefix):
+  #the "S" of "S01E02" isn't part of the name
+  if prefix[-1:] in ("s", "S") and not prefix[-2:-1].isalnum():
+    prefix = prefix[:-1]
+  return search.normalize(prefix)
+
+def index_directory(names, subtitles = (), grouped = None):
+  """Builds the episodes of a directory from the names of its files.
+
+  For each episode and extension, the first name in sorted order is kept.
+  Episodes with subtitles only are left out. If the videos of the
+  directory belong to more than one series, as in a directory where many
+  series are downloaded, the videos of every episode are also grouped by
+  the "series" of their names, so that find_file() can pick the ones of
+  the entry; if a series has more than one video for an episode, all of
+  them are listed, so that find_file() can rank them.
+
+  Args:
+    names: The names of the files in the directory.
+    subtitles: Optional. Subtitles found outside the directory, as tuples
+               (relative path, set of (season, episode) tuples, tags).
+    grouped: Optional. Whether the videos are grouped by series, for
+             "names" that are only some of the files of the directory.
+             Default value: whether "names" hold more than one series.
+
+  Returns:
+    A dictionary mapping a (season, episode) tuple to a dictionary
+    {extension: file name} for the videos; the key "subs" holds a list of
+    the candidate subtitles, as tuples (relative path, extension, tags),
+    the key "series", in a directory of more than one series, a
+    dictionary {series: {extension: file name}}, and the key "videos", for
+    episodes with more than one video of a series, a dictionary {series:
+    sorted list of the names of its videos}.
+  """
+  episodes = {}
+  series = {}
+  videos = {}
+  candidates = []
+  for name in sorted(names):
+    info = classify(name)
+    if info.extension in set_extensions:
+      for key in info.keys:
+        episodes.setdefault(key, {}).setdefault(info.extension, name)
+        videos.setdefault(key, {}).setdefault(info.series, []).append(name)
+        series.setdefault(key, {}).setdefault(info.series, {})\
+              .setdefault(info.extension, name)
+    elif info.extension in subtitle_extensions:
+      candidates.append((name, info.keys, info.tags))
+  candidates.extend(subtitles)
+  for (path, keys, tags) in candidates:
+    ext = path.rpartition(".")[2]
+    for key in keys:
+      if key in episodes:
+        episodes[key].setdefault("subs", []).append((path, ext, tags))
+  if grouped == None:
+    #the names without a series don't make a series of their own
+    grouped = len(set(s for names in series.values() for s in names if s)) > 1
+  if grouped:
+    for (key, names) in series.items():
+      episodes[key]["series"] = names
+  for (key, names) in videos.items():
+    if any(len(n) > 1 for n in names.values()):
+      episodes[key]["videos"] = names
+  return episodes
+
+def read_directory(directory):
+  """Lists a directory and indexes its episodes and their subtitles.
+
+  Subtitles are looked for in the directory itself and in its subtitle
+  folders (e.g. "Subs"), either directly or in a folder named after the
+  episode, as in "Subs/Show.S01E02/2_English.srt".
+
+  Args:
+    directory: The path of the directory.
+
+  Raises:
+    OSError: The directory couldn't be accessed
+
+  Returns:
+    A tuple (signature, episodes, subdirectories): "signature" is used by
+    Index to tell if the directory changed, "episodes" is as returned by
+    index_directory(), and "subdirectories" is a list of the paths of the
+    subdirectories other than the subtitle folders, not following links.
+  """
+  #the mtime is taken before listing, so a change made while listing is
+  #seen at the next lookup
+  signature = [("", os.stat(directory).st_mtime_ns)]
+  names = []
+  subdirs = []
+  subtitles = []
+  with os.scandir(directory) as it:
+    for entry in it:
+      if not entry.is_dir():
+        names.append(entry.name)
+      elif entry.name.lower() in subtitle_dirs:
+        try:
+          signature.append((entry.name, entry.stat().st_mtime_ns))
+          subtitles.extend(_read_subtitle_dir(entry.path, entry.name))
+        except OSError:
+          pass
+      elif not entry.is_symlink():
+        subdirs.append(entry.path)
+  return (tuple(signature), index_directory(names, subtitles), subdirs)
+
+def _read_subtitle_dir(path, relative):
+  subtitles = []
+  with os.scandir(path) as it:
+    for entry in sorted(it, key=lambda e: e.name):
+      info = classify(entry.name)
+      if entry.is_dir():
+        #a folder for each episode, with a file for each language
+        #as a path, so that the name can end with the episode number
+        keys = classify(entry.name + "/.").keys
+        if not keys:
+          continue
+        with os.scandir(entry.path) as inner:
+          for sub in sorted(inner, key=lambda e: e.name):
+            (stem, _, ext) = sub.name.rpartition(".")
+            if ext in subtitle_extensions:
+              subtitles.append((os.path.join(relative, entry.name, sub.name),
+                                keys, tuple(_tag_expr.findall(stem.lower()))))
+      elif info.extension in subtitle_extensions:
+        subtitles.append((os.path.join(relative, entry.name), info.keys,
+                          info.tags))
+  return subtitles
 
-def find_file(entry, find_subs = False):
+def _unchanged(directory, signature):
+  try:
+    return all(os.stat(os.path.join(directory, name)).st_mtime_ns == mtime
+               for (name, mtime) in signature)
+  except OSError:
+    return False
+
+def get_languages():
+  """Returns the preferred subtitle languages, most preferred first.
+
+  They're read from the environment variable "PLAY_EPISODE_SUB_LANGS", a
+  comma separated list of tags (e.g. "it,ita,en"); "default_languages" is
+  used if it isn't set.
+  """
+  var = os.environ.get(languages_var)
+  if var:
+    return tuple(lang.strip().lower() for lang in var.split(",")
+                 if lang.strip())
+  return default_languages
+
+def rank_subtitles(subtitles, languages = None):
+  """Sorts candidate subtitles, best first.
+
+  Subtitles tagged with a preferred language come first, in order of
+  preference, followed by the ones without a known language; ties are
+  broken by the order of "subtitle_extensions", preferring the files next
+  to the video to the ones in subtitle folders.
+
+  Args:
+    subtitles: A list of tuples (relative path, extension, tags).
+    languages: Optional. The preferred languages, as in get_languages().
+
+  Returns:
+    The sorted list.
+  """
+  if languages == None:
+    languages = get_languages()
+  rank = {lang: i for i, lang in enumerate(languages)}
+  def key(sub):
+    (path, ext, tags) = sub
+    return (min((rank[t] for t in tags if t in rank), default=len(rank)),
+            subtitle_extensions.index(ext), os.sep in path, path)
+  return sorted(subtitles, key=key)
+
+@tracing.traced("find.find_file")
+def find_file(entry, find_subs = False, save = True):
   """Finds a path for a file based on entry
 
   This function takes from an "entry" variable the data to
   return a string containing a path to the best matching episode.
-  As of now, "mkv" files are preferred to "mp4", which are preferred
-  to "avi". If "find_subs" is True, returns a tuple with a suitable
-  subtitle path as the second element, or None.
+  If there's more than one video for the episode, they're ranked by
+  probe.rank(), by their resolution and the like, once their metadata is
+  known; until it is (it's probed in the background, never here), "mkv"
+  files are preferred to "mp4", which are preferred to "avi", as in
+  "set_extensions". If the directory holds more than one series, only the
+  videos whose name contains the name of the series are chosen, the
+  shortest if there are many (so "Show" prefers "Show.S01E02.720p.mkv"
+  to "Show.Extra.S01E02.720p.mkv"), or else the ones with no series in
+  their name. If "find_subs" is True, returns a tuple with a suitable
+  subtitle path as the second element, or None; subtitles are found with
+  the video, and ranked by rank_subtitles().
+  The directory is looked up through "index", so it is listed only if it
+  changed since the last lookup.
 
   Args:
-    entry:  A container-like variable with at least four elements:
-            entry["name"] is the name of the series
-            entry["season"], entry["episode"] are the number of the season
+    entry:  A data.Entry, or an object with the same attributes:
+            entry.name is the name of the series
+            entry.season, entry.episode are the number of the season
               and the episode
-            entry["path"] is the path in which to look for the episode
+            entry.path is the path in which to look for the episode
     find_subs:  If True and a file name was found, returns a tuple with
                 the path with the corresponding subtitles, if found, None
                 otherwise.
+    save: As in Index.episodes().
 
   Raises:
     NotFoundError: No suitable match for the given entry was found
+    OSError: The directory in entry.path couldn't be accessed
 
   Return:
     If an episode was found, returns the path of the episode. If "find_subs"
@@ -48,34 +411,202 @@ def find_file(entry, find_subs = False):
     element, and the path to the subtitle (or None, if no subtitle was
     found) as the second.
   """
-  os.chdir(entry["path"])
-#  gen_expr = lambda x: r".*0*{0}[xXeE]0*{1}.*\.{2}$".format(
-#    int(entry["season"]), int(entry["episode"]), x
-#  )
-  try:
+  return _resolve(index.episodes(entry.path, save), entry, find_subs)
+
+def find_files(entries, find_subs = False):
+  """Finds the paths for many entries at once.
+
+  Entries sharing a directory are resolved with a single lookup of that
+  directory in "index", which is saved once at the end.
+
+  Args:
+    entries: An iterable of entries, as in find_file().
+    find_subs: As in find_file().
+
+  Returns:
+    A list with an element for each entry: the value find_file() would
+    return for it, or None if no suitable match was found or its
+    directory couldn't be accessed.
+  """
+  dirs = {}
+  results = []
+  for entry in entries:
+    path = entry.path
+    if path not in dirs:
+      try:
+        dirs[path] = index.episodes(path, save=False)
+      except OSError:
+        dirs[path] = None
+    try:
+      if dirs[path] == None:
+        raise NotFoundError
+      results.append(_resolve(dirs[path], entry, find_subs))
+    except NotFoundError:
+      results.append(None)
+  index.flush()
+  return results
+
+def step_episode(entry, step, cached = False):
+  """Finds an episode on disk before or after the one of an entry.
+
+  The episodes of the series in entry.path are kept in order, each file
+  as an interval of episodes (a file such as "Show.S01E01-E02.720p.mkv"
+  is one step), so that moving across the end of a season is as quick as
+  within it. As in find_file(), if the directory holds more than one
+  series, only the files whose name contains the name of the series are
+  considered, or else the ones with no series in their name.
+
+  Args:
+    entry: An entry, as in find_file().
+    step: The number of episodes to move: positive to move forward,
+          negative to move back.
+    cached: Optional. If True, only the episodes already in "index" are
+            used, without even checking that the directory changed, so
+            that the lookup can't block; if the directory isn't there,
+            None is returned.
+
+  Raises:
+    OSError: The directory in entry.path couldn't be accessed
+
+  Returns:
+    A tuple (season, episode) with the first episode of the file "step"
+    files away from the one of the entry, or None if there's none.
+  """
+  if cached:
+    found = index.get(entry.path)
+    if found == None:
+      return None
+    episodes = found[1]
+  else:
+    episodes = index.episodes(entry.path)
+  (starts, intervals) = _series_order(entry.path, episodes,
+                                      search.normalize(entry.name))
+  current = (entry.season, entry.episode)
+  if step > 0:
+    i = bisect.bisect_right(starts, current) + step - 1
+  else:
+    i = bisect.bisect_left(starts, current)
+    #the file holding the current episode doesn't count
+    if i > 0 and intervals[i-1][0] == entry.season and\
+       intervals[i-1][2] >= entry.episode:
+      i -= 1
+    i += step
+  if 0 <= i < len(intervals):
+    return starts[i]
+  return None
+
+def video_names(episodes):
+  """Returns the set of the names of the videos in the episodes of a
+  directory, as returned by index_directory()."""
+  names = set()
+  for found in episodes.values():
+    names.update(name for (ext, name) in found.items()
+                 if ext in set_extensions)
+    for videos in found.get("videos", {}).values():
+      names.update(videos)
+  return names
+
+#For each directory, a tuple with the episodes it was built from, the
+#ordered episodes of each series and the ordered episodes of all of them
+_orders = {}
+
+def _episode_order(directory, episodes):
+  cached = _orders.get(directory)
+  if cached != None and cached[0] is episodes:
+    return cached[1:]
+  by_series = {}
+  for name in video_names(episodes):
+    info = classify(name)
+    by_series.setdefault(info.series, set())\
+             .add((info.season, info.episode, info.last))
+  orders = {series: _order(intervals)
+            for (series, intervals) in by_series.items()}
+  everything = _order(set().union(*by_series.values()))
+  _orders[directory] = (episodes, orders, everything)
+  return (orders, everything)
+
+def _order(intervals):
+  intervals = sorted(intervals)
+  return ([i[:2] for i in intervals], intervals)
+
+def _series_order(directory, episodes, series):
+  (orders, everything) = _episode_order(directory, episodes)
+  matches = [s for s in orders if series and series in s]
+  if matches:
+    return orders[min(matches, key=lambda s: (len(s), s))]
+  if sum(1 for s in orders if s) > 1:
+    return orders.get("", ([], []))
+  return everything
+
+def _resolve(episodes, entry, find_subs):
+  found = episodes.get((entry.season, entry.episode), {})
+  videos = found
+  subs = found.get("subs", ())
+  series = None
+  if "series" in found:
+    (videos, subs, series) = _match_series(found,
+                                           search.normalize(entry.name))
+  name = None
+  groups = found.get("videos", {})
+  if series != None:
+    candidates = groups.get(series, ())
+  else:
+    candidates = [name for names in groups.values() for name in names]
+  if len(candidates) > 1:
+    import probe
+    ranked = probe.rank([os.path.join(entry.path, n) for n in candidates])
+    if ranked:
+      name = ranked[0]
+  if name == None:
     for ext in set_extensions:
-      expr = gen_expr(entry["season"], entry["episode"], ext)
-      for name in sorted(os.listdir()):
-        if re.match(expr,name):
-          raise _FoundError
+      if ext in videos:
+        name = os.path.join(entry.path, videos[ext])
+        break
     else:
       raise NotFoundError
-  except _FoundError:
-    if not find_subs:
-      #with open("play.log", "a") as f:
-        #print(name, file=f)
-      return name
-
-  expr = gen_expr(entry["season"], entry["episode"], "srt")
-  for sub in sorted(os.listdir()):
-    if re.match(expr,sub):
-      return (name,sub)
+  if not find_subs:
+    return name
+
+  subs = rank_subtitles(subs)
+  if subs:
+    return (name, os.path.join(entry.path, subs[0][0]))
   else:
     return (name,None)
-    
+
+def _match_series(found, series):
+  """Picks the videos and subtitles of a series among the ones of an episode.
+
+  Only the candidates of the episode are looked at, not the whole
+  directory.
+
+  Raises:
+    NotFoundError: No video of the episode belongs to the series
+
+  Returns:
+    A tuple (videos, subtitles, series): "videos" is {extension: file
+    name}, "subtitles" the list of the candidate subtitles and "series"
+    the series of the names chosen. If no name contains the series, the
+    videos without a series in their name are chosen.
+  """
+  matches = [s for s in found["series"] if series and series in s]
+  if matches:
+    best = min(matches, key=lambda s: (len(s), s))
+  elif "" in found["series"]:
+    best = ""
+  else:
+    raise NotFoundError
+  #a subtitle belongs to the longest series contained in its name, if any
+  subs = []
+  for sub in found.get("subs", ()):
+    name = classify(sub[0].replace(os.sep, "/") + "/.").series
+    owners = [s for s in found["series"] if s and s in name]
+    if not owners or max(owners, key=len) == best:
+      subs.append(sub)
+  return (found["series"][best], subs, best)
 
 if __name__ == "__main__":
-  data_list = data.get_data()
+  data_list = data.Data()
+  data_list.get_data()
   for elem in data_list:
     name = find_file(elem, True)
     print(name)
@@ -0,0 +1,193 @@
+#! /usr/bin/env python3
+
+import os
+import mmap
+import hashlib
+import data
+import find
+
+fingerprints_name = "play_episode.fingerprints"
+fingerprints_version = 1
+#The blocks hashed in each file, spread evenly from its start to its end
+samples = 8
+block_size = 64 * 1024
+
+class Fingerprints(data.PickledCache):
+  """Persistent cache of the fingerprints of files.
+
+  Maps the (device, inode) of a file to a tuple (size, mtime, digest); a
+  fingerprint is used only while the size and the mtime of the file don't
+  change, so renamed or moved files keep theirs.
+
+  Attributes:
+    path: The file where the cache is saved.
+    lock: The lock held while the cache is changed, loaded or saved.
+  """
+  name = fingerprints_name
+  version = fingerprints_version
+
+  def get_fingerprints(self):
+    """Loads the cache saved in "path", if it can be read."""
+    self.read()
+
+  def save_fingerprints(self):
+    """Saves the cache to "path", through a temporary file.
+
+    Raises:
+      IOError: The cache couldn't be saved
+    """
+    self.write()
+
+  def fingerprint(self, path, st = None):
+    """Returns the fingerprint of a file, computing it only if needed.
+
+    Args:
+      path: The path of the file.
+      st: Optional. The os.stat_result of the file, if already known.
+
+    Raises:
+      OSError: The file couldn't be read
+    """
+    if st == None:
+      st = os.stat(path)
+    key = (st.st_dev, st.st_ino)
+    cached = self.get(key)
+    if cached != None and cached[:2] == (st.st_size, st.st_mtime_ns):
+      return cached[2]
+    digest = fingerprint(path, st.st_size)
+    with self.lock:
+      self[key] = (st.st_size, st.st_mtime_ns, digest)
+    return digest
+
+def fingerprint(path, size):
+  """Computes the fingerprint of a file from a few sampled blocks.
+
+  The file is mapped in memory, and only the "samples" blocks of
+  "block_size" bytes are hashed, together with the size: two different
+  episodes of the same size differ in their headers already, and in the
+  streams around the samples. A file changed in place only between the
+  samples keeps its fingerprint.
+
+  Args:
+    path: The path of the file.
+    size: The size of the file.
+
+  Raises:
+    OSError: The file couldn't be read
+
+  Returns:
+    The digest, as bytes.
+  """
+  h = hashlib.blake2b(str(size).encode(), digest_size=16)
+  if size == 0:
+    return h.digest()
+  with open(path, "rb") as f:
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+      if size <= samples * block_size:
+        h.update(m)
+      else:
+        last = size - block_size
+        for i in range(samples):
+          offset = last * i // (samples - 1)
+          h.update(m[offset:offset + block_size])
+  return h.digest()
+
+def duplicates(paths, fingerprints = None):
+  """Finds the files with the same content.
+
+  Files are grouped by size first, so that a file whose size is unique is
+  never read; the others are compared by fingerprint. Hard links to the
+  same file are reported as duplicates, reading it once.
+
+  Args:
+    paths: The paths of the files to compare.
+    fingerprints: Optional. The Fingerprints cache to use; it isn't
+                  saved. Default value: a cache loaded from its file.
+
+  Returns:
+    A list of groups of duplicates, each a sorted list of paths, sorted by
+    their first path. Files that couldn't be read are left out.
+  """
+  if fingerprints == None:
+    fingerprints = Fingerprints()
+    fingerprints.get_fingerprints()
+  sizes = {}
+  for path in set(paths):
+    try:
+      st = os.stat(path)
+    except OSError:
+      continue
+    sizes.setdefault(st.st_size, []).append((path, st))
+  groups = {}
+  for (size, files) in sizes.items():
+    if len(files) < 2:
+      continue
+    for (path, st) in files:
+      try:
+        digest = fingerprints.fingerprint(path, st)
+      except OSError:
+        continue
+      groups.setdefault(digest, []).append(path)
+  return sorted(sorted(group) for group in groups.values() if len(group) > 1)
+
+def collapse(groups):
+  """Chooses the copy of each group of duplicates to keep.
+
+  The copy with the shortest path is kept, the first in sorted order if
+  there's more than one, so the choice doesn't depend on the order in
+  which the files were found.
+
+  Args:
+    groups: Groups of duplicates, as returned by duplicates().
+
+  Returns:
+    A dictionary mapping the path of each copy not kept to the path of the
+    one kept.
+  """
+  kept = {}
+  for group in groups:
+    keep = min(group, key=lambda p: (len(p), p))
+    kept.update((path, keep) for path in group if path != keep)
+  return kept
+
+def library_videos(index = None):
+  """Returns the paths of the videos in an episode index.
+
+  Args:
+    index: Optional. The find.Index. Default value: find.index, loaded.
+  """
+  if index == None:
+    index = find.index
+    index.load()
+  return [os.path.join(directory, name)
+          for (directory, (signature, episodes)) in list(index.items())
+          for name in find.video_names(episodes)]
+
+def _inode(path):
+  st = os.stat(path)
+  return (st.st_dev, st.st_ino)
+
+if __name__ == "__main__":
+  #prints the duplicates among the videos indexed, scanning the library
+  #first if "PLAY_EPISODE_ROOTS" is set
+  if os.environ.get("PLAY_EPISODE_ROOTS"):
+    import library
+    library.scan(library.get_roots())
+  cache = Fingerprints()
+  cache.get_fingerprints()
+  groups = duplicates(library_videos(), cache)
+  kept = collapse(groups)
+  #hard links to a kept file, or to each other, don't take space
+  inodes = set(_inode(keep) for keep in kept.values())
+  wasted = 0
+  for (path, keep) in sorted(kept.items()):
+    if _inode(path) not in inodes:
+      inodes.add(_inode(path))
+      wasted += os.stat(path).st_size
+    print("{}\n  duplicates {}".format(path, keep))
+  print("{} groups of duplicates, {:.1f} MiB in extra copies".format(
+        len(groups), wasted / 2**20))
+  try:
+    cache.save_fingerprints()
+  except IOError:
+    pass
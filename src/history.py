@@ -0,0 +1,321 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import mmap
+import time
+import struct
+import datetime
+import collections
+import threading
+import data
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+history_name = "play_episode.history"
+series_suffix = ".series"
+_magic = b"PEHIST1\n"
+#timestamp, series id, season, episode, seconds watched
+_record = struct.Struct("<qIHHf")
+if numpy != None:
+  _dtype = numpy.dtype([("time", "<i8"), ("series", "<u4"),
+                        ("season", "<u2"), ("episode", "<u2"),
+                        ("seconds", "<f4")])
+
+Watched = collections.namedtuple("Watched", ["time", "name", "path",
+                                             "season", "episode", "seconds"])
+
+class History:
+  """The log of the episodes watched.
+
+  Every time an episode is played, a fixed size record is appended to the
+  log in "path": the time it started (in seconds since the epoch), the id
+  of its series, its season and episode, and the seconds it was watched
+  for. The names and paths of the series are kept in a text file next to
+  it, "path" plus "series_suffix", with a line for each id.
+  Queries map the log in memory and scan it as a numpy array if numpy is
+  available, with struct.iter_unpack() otherwise. The log is created
+  with its header already in it, and records are appended with a single
+  write to a file opened for appending, so two programs can write to the
+  log at the same time; a record cut short by a crash is ignored.
+
+  Attributes:
+    path: The path of the log.
+  """
+  def __init__(self, path = None):
+    if path == None:
+      path = os.path.join(data.base_dir, history_name)
+    self.path = path
+    self._series = None
+    self._ids = None
+    self._lock = threading.Lock()
+
+  def record(self, entry, seconds, when = None):
+    """Appends a record to the log.
+
+    Args:
+      entry: The data.Entry played.
+      seconds: The seconds it was watched for.
+      when: Optional. The time it started, in seconds since the epoch.
+            Default value: "seconds" before now.
+
+    Raises:
+      OSError: The log couldn't be written
+    """
+    if when == None:
+      when = time.time() - seconds
+    with self._lock:
+      data._assure_dir(os.path.dirname(self.path))
+      series_id = self._series_id(entry.name, entry.path)
+      record = _record.pack(int(when), series_id, entry.season,
+                            entry.episode, seconds)
+      if not os.path.exists(self.path):
+        _create(self.path)
+      fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+      try:
+        os.write(fd, record)
+      finally:
+        os.close(fd)
+
+  def series(self):
+    """Returns the list of the series in the log, as tuples (name, path),
+    indexed by their id."""
+    with self._lock:
+      self._load_series()
+      return list(self._series)
+
+  def totals(self):
+    """Returns the totals of each series.
+
+    Returns:
+      A dictionary mapping a tuple (name, path) to a tuple (number of
+      episodes played, seconds watched).
+    """
+    series = self.series()
+    with self._map() as records:
+      #an array can't be compared to None with ==
+      if records is None:
+        return {}
+      if numpy != None:
+        counts = numpy.bincount(records["series"], minlength=len(series))
+        seconds = numpy.bincount(records["series"], weights=records["seconds"],
+                                 minlength=len(series))
+        return {series[i]: (int(counts[i]), float(seconds[i]))
+                for i in numpy.flatnonzero(counts) if i < len(series)}
+      totals = {}
+      for (when, i, season, episode, secs) in records:
+        (count, total) = totals.get(i, (0, 0.0))
+        totals[i] = (count + 1, total + secs)
+      return {series[i]: total for (i, total) in totals.items()
+              if i < len(series)}
+
+  def last(self, n):
+    """Returns the last "n" episodes played, most recent first, as Watched
+    tuples."""
+    series = self.series()
+    with self._map() as records:
+      if records is None or n <= 0:
+        return []
+      if numpy != None:
+        rows = records[-n:][::-1].tolist()
+      else:
+        rows = records.tail(n)[::-1]
+      return [Watched(when, *series[i], season, episode, secs)
+              for (when, i, season, episode, secs) in rows
+              if i < len(series)]
+
+  def daily(self):
+    """Returns the seconds watched each day, in local time.
+
+    Returns:
+      A dictionary mapping a datetime.date to the seconds watched in the
+      episodes started that day.
+    """
+    with self._map() as records:
+      #an array can't be compared to None with ==
+      if records is None:
+        return {}
+      #the offset from UTC is looked up once a day, except for the days
+      #when it changes
+      epoch = datetime.date(1970, 1, 1)
+      if numpy != None:
+        times = records["time"]
+        (utc_days, inverse) = numpy.unique(times // 86400,
+                                           return_inverse=True)
+        (first, last) = (numpy.array([_offset(int(d) * 86400 + s)
+                                      for d in utc_days], dtype="<i8")
+                         for s in (0, 86399))
+        offsets = first[inverse]
+        changed = (first != last)[inverse]
+        offsets[changed] = [_offset(int(t)) for t in times[changed]]
+        (days, inverse) = numpy.unique((times + offsets) // 86400,
+                                       return_inverse=True)
+        seconds = numpy.bincount(inverse, weights=records["seconds"])
+        return {epoch + datetime.timedelta(days=int(d)): float(s)
+                for (d, s) in zip(days, seconds)}
+      totals = {}
+      offsets = {}
+      for (when, i, season, episode, secs) in records:
+        utc_day = when // 86400
+        offset = offsets.get(utc_day)
+        if offset == None:
+          first = _offset(utc_day * 86400)
+          last = _offset(utc_day * 86400 + 86399)
+          offset = offsets[utc_day] = first if first == last else False
+        if offset is False:
+          offset = _offset(when)
+        day = (when + offset) // 86400
+        totals[day] = totals.get(day, 0.0) + secs
+      return {epoch + datetime.timedelta(days=d): s
+              for (d, s) in totals.items()}
+
+  def _series_id(self, name, path):
+    self._load_series()
+    key = (name, path)
+    if key not in self._ids:
+      with open(self.path + series_suffix, "a") as f:
+        f.write("{}|{}|\n".format(name, path))
+      #another program may have added series meanwhile
+      self._series = None
+      self._load_series()
+    return self._ids[key]
+
+  def _load_series(self):
+    if self._series != None:
+      return
+    self._series = []
+    try:
+      with open(self.path + series_suffix) as f:
+        for line in f:
+          (name, path) = line.split("|")[:2]
+          self._series.append((name, path))
+    except (IOError, ValueError):
+      pass
+    self._ids = {}
+    for (i, key) in enumerate(self._series):
+      self._ids.setdefault(key, i)
+
+  def _map(self):
+    return _Mapped(self.path)
+
+class _Mapped:
+  """Maps the records of a log in memory, as a context manager.
+
+  The value is a numpy array of records if numpy is available, a
+  _Records otherwise, or None if the log is empty or doesn't exist.
+  """
+  def __init__(self, path):
+    self.path = path
+    self.file = None
+    self.map = None
+    self.records = None
+
+  def __enter__(self):
+    try:
+      self.file = open(self.path, "rb")
+      size = os.fstat(self.file.fileno()).st_size
+    except (IOError, OSError):
+      return None
+    count = (size - len(_magic)) // _record.size
+    if count <= 0:
+      return None
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    if self.map[:len(_magic)] != _magic:
+      return None
+    if numpy != None:
+      return numpy.frombuffer(self.map, _dtype, count, len(_magic))
+    self.records = _Records(self.map, count)
+    return self.records
+
+  def __exit__(self, *args):
+    if self.records != None:
+      self.records.view.release()
+    if self.map != None:
+      try:
+        self.map.close()
+      except BufferError:
+        #an array still points to it; it's closed when it's freed
+        pass
+    if self.file != None:
+      self.file.close()
+
+class _Records:
+  """The records of a mapped log, unpacked with struct."""
+  def __init__(self, buffer, count):
+    self.view = memoryview(buffer)[len(_magic):
+                                   len(_magic) + count * _record.size]
+    self.count = count
+
+  def __iter__(self):
+    return _record.iter_unpack(self.view)
+
+  def tail(self, n):
+    start = max(self.count - n, 0) * _record.size
+    return list(_record.iter_unpack(self.view[start:]))
+
+def _create(path):
+  """Creates a log with just its header, unless it already exists.
+
+  The header is written to a temporary file which is then linked in
+  place, so that no other program can append a record to the log before
+  the header is there; where hard links aren't supported, the log is
+  created exclusively, and the header written right after.
+  """
+  tmp_path = "{}.{}.tmp".format(path, os.getpid())
+  fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+  try:
+    os.write(fd, _magic)
+  finally:
+    os.close(fd)
+  try:
+    os.link(tmp_path, path)
+  except FileExistsError:
+    pass
+  except OSError:
+    try:
+      fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+      pass
+    else:
+      try:
+        os.write(fd, _magic)
+      finally:
+        os.close(fd)
+  finally:
+    os.remove(tmp_path)
+
+def _offset(when):
+  return time.localtime(when).tm_gmtoff
+
+_history = None
+
+def get_history():
+  """Returns the History shared by the program."""
+  global _history
+  if _history == None:
+    _history = History()
+  return _history
+
+if __name__ == "__main__":
+  #prints the totals of each series, the last episodes watched and the
+  #time watched in the last days
+  history = get_history()
+  start = time.perf_counter()
+  totals = history.totals()
+  last = history.last(10)
+  daily = history.daily()
+  elapsed = time.perf_counter() - start
+  for ((name, path), (count, seconds)) in sorted(totals.items()):
+    print("{:30} {:5d} episodes {:8.1f} h".format(name, count, seconds / 3600))
+  print()
+  for w in last:
+    print("{} {} - {:02d}x{:02d} ({:.0f} min)".format(
+          time.strftime("%Y-%m-%d %H:%M", time.localtime(w.time)), w.name,
+          w.season, w.episode, w.seconds / 60))
+  print()
+  for day in sorted(daily)[-7:]:
+    print("{} {:6.1f} min".format(day, daily[day] / 60))
+  print("\nqueried in {:.1f} ms ({})".format(elapsed * 1000, "numpy"
+        if numpy != None else "struct"), file=sys.stderr)
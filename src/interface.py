@@ -1,11 +1,21 @@
 #! /usr/bin/env python3
 
 import curses
+import os
+import sys
+import time as _time
+import selectors
+import threading
+import collections
+import tracing
 
 
 margin_up = 0
 margin_left = 0
 
+#The module used to draw on the terminal, see use_backend()
+backend = curses
+
 class TimeError(Exception):
   """Exception to be used to mean an operation took too much time"""
   pass
@@ -56,7 +66,7 @@ class Window:
       dim_col = stdscr.getmaxyx()[1] - margin_left
     start_row += margin_up
     start_col += margin_left
-    self.win = curses.newwin(dim_row, dim_col, start_row, start_col)
+    self.win = backend.newwin(dim_row, dim_col, start_row, start_col)
     self.win.keypad(True)
     self.dim_row, self.dim_col, self.start_row, self.start_col =\
     dim_row, dim_col, start_row, start_col
@@ -143,6 +153,22 @@ class Window:
     return Window(dim_row, dim_col, start_row, start_col)
 
     
+def use_backend(module):
+  """Draws the interface through "module" instead of curses.
+
+  Used to run the interface without a terminal. "module" must offer the
+  functions and attributes of curses used by this module (initscr,
+  newwin, noecho, cbreak, nocbreak, echo, endwin, curs_set, LINES, COLS,
+  A_BOLD, A_REVERSE), and its windows must raise curses.error when
+  curses would. Keys are only read from its windows: when no key is
+  available, there's nothing to wait for, and TimeError is raised.
+
+  Args:
+    module: The new backend, or curses to go back to the terminal.
+  """
+  global backend
+  backend = module
+
 def start():
   """Initializes curses.
   """
@@ -150,25 +176,26 @@ def start():
   global win_input
   global get_char
 
-  stdscr = curses.initscr()
-  curses.noecho()
-  curses.cbreak()
+  stdscr = backend.initscr()
+  backend.noecho()
+  backend.cbreak()
   stdscr.keypad(True)
-  curses.curs_set(False)
+  backend.curs_set(False)
   stdscr.clear()
   stdscr.refresh()
-  win_input = Window(1,1, curses.LINES-1, curses.COLS-1)
+  win_input = Window(1,1, backend.LINES-1, backend.COLS-1)
   get_char = win_input.get_char
+  _start_loop()
 
 def close():
   """Closes ncurses.
 
   Closes ncurses and ripristinates shell mode.
   """
-  curses.nocbreak()
+  backend.nocbreak()
   stdscr.keypad(False)
-  curses.echo()
-  curses.endwin()
+  backend.echo()
+  backend.endwin()
 
 def clear_screen():
   """Clears the screen"""
@@ -218,49 +245,249 @@ def choice_screen(title, *choices, high=-1, start_row = 0, start_col = 0):
   """
   screen = Window(2 + len(choices) + 1,\
                   start_row = start_row, start_col = start_col)
-  screen.print_str(title + "\n\n", curses.A_BOLD)
+  screen.print_str(title + "\n\n", backend.A_BOLD)
   pad = len(max(choices,key=len))
   for i,line in enumerate(choices):
     if i == high:
-      screen.print_str(line.ljust(pad) + "\n", curses.A_REVERSE)
+      screen.print_str(line.ljust(pad) + "\n", backend.A_REVERSE)
     else:
       screen.print_str(line.ljust(pad) + "\n")
   screen.refresh()
   return screen
 
-def get_delayed_char(time):
+class Menu:
+  """A screen to choose from a number of alternatives, redrawn in place.
+
+  Unlike choice_screen(), the window is created once and reused: each call
+  to draw() only repaints the lines whose content or highlight changed
+  since the previous call, so that moving the selection writes two lines
+  to the terminal. If there are more choices than lines in the terminal,
+  only the ones in a viewport around the highlighted line are drawn, so
+  that the cost of drawing depends only on the size of the viewport.
+
+  Attributes:
+    title: The title of the screen.
+    start_row: The vertical offset of the window.
+    start_col: The horizontal offset of the window.
+    screen: The Window of the menu, or None if it wasn't drawn yet.
+    height: The number of choices shown at the same time.
+    top: The index of the first choice shown.
+  """
+  def __init__(self, title, start_row = 0, start_col = 0):
+    self.title = title
+    self.start_row = start_row
+    self.start_col = start_col
+    self.screen = None
+    self.height = 0
+    self.top = 0
+    self.rows = []
+    self.pad = 0
+
+  @tracing.traced("interface.Menu.draw")
+  def draw(self, choices, high = -1):
+    """Draws the menu, repainting only what changed.
+
+    Args:
+      choices: The lines to be printed as choices beneath the title; any
+               sequence supporting len() and indexing.
+      high: Optional. The line to highlight. If it's out of range, no line
+            is highlighted; otherwise, the viewport is scrolled to show it.
+    """
+    n_choices = len(choices)
+    #the title, a blank line and a last line for the cursor
+    height = max(min(n_choices,
+                     backend.LINES - margin_up - self.start_row - 3), 1)
+    if self.screen == None or height != self.height:
+      if self.screen != None:
+        #the new window could be smaller than the old one
+        self.screen.clear()
+        self.screen.refresh()
+      self.screen = Window(2 + height + 1, start_row = self.start_row,
+                           start_col = self.start_col)
+      self.height = height
+      self.rows = [None] * height
+      self.pad = -1
+    if 0 <= high < n_choices:
+      if high < self.top:
+        self.top = high
+      elif high >= self.top + height:
+        self.top = high - height + 1
+    self.top = max(min(self.top, n_choices - height), 0)
+    rows = [(choices[j], j == high)
+            for j in range(self.top, min(self.top + height, n_choices))]
+    rows += [("", False)] * (height - len(rows))
+
+    changed = [i for i, row in enumerate(rows) if row != self.rows[i]]
+    if not changed:
+      return
+    if any(self.rows[i] == None or rows[i][0] != self.rows[i][0]
+           for i in changed):
+      pad = min(max(len(line) for line, _ in rows), self.screen.dim_col - 1)
+      if pad != self.pad:
+        #every line has to be padded again
+        self.pad = pad
+        self.screen.clear()
+        self.screen.print_str(0, 0, self.title, backend.A_BOLD)
+        changed = range(height)
+    for i in changed:
+      (line, highlighted) = rows[i]
+      line = line[:self.pad].ljust(self.pad)
+      if highlighted:
+        self.screen.print_str(2 + i, 0, line, backend.A_REVERSE)
+      else:
+        self.screen.print_str(2 + i, 0, line)
+    self.rows = rows
+    self.screen.refresh()
+
+class _Shown:
+  """The lines shown by get_choice().
+
+  A view of the choices whose indices are in "shown" (or of all of them,
+  if "shown" is None), followed by the new line.
+  """
+  def __init__(self, choices, shown, new_input):
+    self.choices = choices
+    self.shown = shown
+    self.new_input = new_input
+
+  def index(self, i):
+    """Returns the index in the choices of the line "i"."""
+    if self.shown == None or i >= len(self.shown):
+      return len(self.choices) if self.shown != None else i
+    return self.shown[i]
+
+  def __len__(self):
+    n_shown = len(self.choices) if self.shown == None else len(self.shown)
+    return n_shown + 1
+
+  def __getitem__(self, i):
+    if i == len(self) - 1:
+      return self.new_input
+    return self.choices[self.index(i)]
+
+_callbacks = collections.deque()
+_selector = None
+_wakeup = None
+
+def _start_loop():
+  global _selector, _wakeup
+  if _selector != None or backend is not curses:
+    return
+  _wakeup = os.pipe()
+  for fd in _wakeup:
+    os.set_blocking(fd, False)
+  _selector = selectors.DefaultSelector()
+  _selector.register(sys.stdin.fileno(), selectors.EVENT_READ)
+  _selector.register(_wakeup[0], selectors.EVENT_READ)
+
+def call_soon(callback, *args):
+  """Schedules a function to be called by the thread waiting for input.
+
+  It can be called from any thread: the function is called the next time
+  the interface waits for a key (or immediately, if it's already
+  waiting), so that background jobs can safely update the screen.
+
+  Args:
+    callback: The function to call.
+    *args: The arguments to pass to the function.
+  """
+  _callbacks.append((callback, args))
+  if _wakeup != None:
     try:
-      c = get_char()
-    except curses.error:
-      if time < 255:
-        curses.cbreak()
-        clear_screen()
+      os.write(_wakeup[1], b"\0")
+    except BlockingIOError:
+      #the pipe is full, so the loop will wake up anyway
+      pass
+
+def background(function, *args, done = None):
+  """Runs a function in a background thread.
+
+  The thread is a daemon, so it doesn't keep the program from exiting.
+
+  Args:
+    function: The function to run.
+    *args: The arguments to pass to the function.
+    done: Optional. A function called with the result of "function"
+          by the thread waiting for input, as in call_soon(), once
+          "function" returns.
+
+  Returns:
+    The started thread.
+  """
+  def run():
+    result = function(*args)
+    if done != None:
+      call_soon(done, result)
+  thread = threading.Thread(target=run, daemon=True)
+  thread.start()
+  return thread
+
+def _run_callbacks():
+  ran = False
+  while _callbacks:
+    (callback, args) = _callbacks.popleft()
+    callback(*args)
+    ran = True
+  return ran
+
+def wait_char(deadline = None):
+  """Waits for a key, running the scheduled callbacks meanwhile.
+
+  The process sleeps until either a key is pressed or a callback is
+  scheduled with call_soon(); there is no polling.
+
+  Args:
+    deadline: Optional. A time, as returned by time.monotonic(), after
+              which to stop waiting.
+
+  Raises:
+    TimeError: No key was pressed before "deadline"
+
+  Returns:
+    The pressed key, as in get_char(), or None if some callbacks were run
+    (so that the caller can draw the screen again).
+  """
+  win_input.win.nodelay(True)
+  try:
+    while True:
+      if _run_callbacks():
+        return None
+      try:
+        return get_char()
+      except curses.error:
+        pass
+      if _selector == None:
+        #no terminal to wait on, as with a backend other than curses
         raise TimeError
+      if deadline == None:
+        timeout = None
       else:
-        time -= 255
-        curses.halfdelay(get_delay(time))
-        c = None
-    return (c, time)
-  
-
-def get_delay(time):
-  if time > 255:
-    return 255
-  else:
-    return time % 256
+        timeout = deadline - _time.monotonic()
+        if timeout <= 0:
+          raise TimeError
+      for (key, events) in _selector.select(timeout):
+        if key.fd == _wakeup[0]:
+          try:
+            os.read(_wakeup[0], 4096)
+          except BlockingIOError:
+            pass
+  finally:
+    win_input.win.nodelay(False)
 
 def get_choice(title, choices, get_input = False, time = -1, i = 0,\
-               handlers = {}):
+               handlers = {}, search = None):
   """Makes the user choose between a number of choices.
 
   Calls choice_screen() with the given choices, and returns the index of
   the chosen line. If "get_input" is True, adds a blank line where the
   user can write a new choice, and returns a tuple with the index of the
   chosen line and any input written in the new line. The user can confirm
-  his choice by pressing Enter. If "time" is greater than -1, if the user
-  doesn't provide any input in "time" tenth of seconds, an exception is
-  raised. If a user does provide some input, but is too slow in doing it,
-  an exception could still be raised; this behaviour should be fixed.
+  his choice by pressing Enter; PageUp and PageDown move the selection
+  by a screen. If "time" is greater than -1, if the user
+  doesn't press any key for "time" tenth of seconds, an exception is
+  raised; the time limit starts again at each key. While waiting,
+  the callbacks scheduled with call_soon() are run, and the screen is
+  drawn again.
 
   Args:
     title: The title of the screen.
@@ -268,21 +495,27 @@ def get_choice(title, choices, get_input = False, time = -1, i = 0,\
     get_input: Optional. If set to true, adds a new blank line to the bottom
                of the screen to be used to write a new choice and alters the
                return value.
-    time: Optional. If time >= 0, wait up to time tenths of a second for an
-          answer. If no answer is given, raises TimeError
+    time: Optional. If time >= 0, wait up to time tenths of a second for
+          each key. If no key is pressed, raises TimeError
     i: Optional. Currently selected line.
     handlers: Optional. If a key is pressed corresponding to an entry in
               "handlers", call the function associated with the key,
               passing the list of choices as the first argument
-              and the current index as the second. "handlers" should be
+              and the current index as the second; the function can
+              change the choice at the current index. "handlers" should be
               (or act like) a dictionary. 
+    search: Optional. Used only if "get_input" is True. A function called
+            with the text in the new line every time it changes, returning
+            the indices of the choices to show, or None to show them all.
 
   Raises:
     TimeError: No input was given in time 
 
   Returns:
     If "get_input" is False, a tuple with the index of the selected
-    line and the last pressed key.
+    line and the last pressed key. The index always refers to "choices",
+    even if only some of them were shown; the new line has the index
+    len(choices).
     If "get_input" is True, a tuple with the index of the selected line,
       the last pressed key and a string containing any input written in the
       new line.
@@ -294,15 +527,24 @@ def get_choice(title, choices, get_input = False, time = -1, i = 0,\
   else:
     max_i = n_lines-1
   min_i = 0
-  if time >= 0:
-    curses.halfdelay(get_delay(time))
+  deadline = None
+  menu = Menu(title)
+  lines = _Shown(choices, None, new_input)
   while True:
-    screen = choice_screen(title, *(choices + [new_input]), high=i)
+    menu.draw(lines, high=i)
 
-    c, time = get_delayed_char(time)
+    #the callbacks run while waiting don't count as keys
+    if time >= 0 and deadline == None:
+      deadline = _time.monotonic() + time / 10
+    try:
+      c = wait_char(deadline)
+    except TimeError:
+      clear_screen()
+      raise
     if c == None:
-      pass
-    elif c == "KEY_DOWN":
+      continue
+    deadline = None
+    if c == "KEY_DOWN":
       i = min(i+1,max_i)
     elif c == "KEY_UP":
       i = max(i-1,min_i)
@@ -310,6 +552,10 @@ def get_choice(title, choices, get_input = False, time = -1, i = 0,\
       i = max_i
     elif c == "KEY_HOME":
       i = min_i
+    elif c == "KEY_NPAGE":
+      i = min(i+menu.height,max_i)
+    elif c == "KEY_PPAGE":
+      i = max(i-menu.height,min_i)
     elif get_input and i == max_i:
       if c.isalnum() or c == ' ':
         new_input += c
@@ -317,21 +563,23 @@ def get_choice(title, choices, get_input = False, time = -1, i = 0,\
         new_input = new_input[:-1]
       else:
         break
+      shown = search(new_input) if search != None else None
+      lines = _Shown(choices, shown, new_input)
+      i = max_i = len(lines) - 1
     else:
       for key in handlers.keys():
         if c == key:
-          handlers[key](choices, i)
+          handlers[key](choices, lines.index(i))
           break
       else:
         break
 
-  curses.cbreak()
   clear_screen()
     
   if get_input:
-    return (i, c, new_input)
+    return (lines.index(i), c, new_input)
   else:
-    return (i, c)
+    return (lines.index(i), c)
 
 def get_season_episode():
   """Asks for a season and an episode number
@@ -346,12 +594,14 @@ def get_season_episode():
   episode_request_title = "What episode?"
   episode = ""
   current_input_line = 1
+  menu = Menu(main_title)
 
   while True:
-    screen = choice_screen(main_title, season_request_title,
-                           season, high=current_input_line)
-    c = get_char()
-    if c.isdigit() or c == " ":
+    menu.draw([season_request_title, season], high=current_input_line)
+    c = wait_char()
+    if c == None:
+      continue
+    elif c.isdigit() or c == " ":
       season = season + c
     elif c == "KEY_BACKSPACE":
       season = season[:-1]
@@ -360,11 +610,12 @@ def get_season_episode():
 
   current_input_line = 3
   while True:
-    screen = choice_screen(main_title, season_request_title,
-                           season, episode_request_title,
-                           episode, high=current_input_line)
-    c = get_char()
-    if c.isdigit() or c == " ":
+    menu.draw([season_request_title, season, episode_request_title,
+               episode], high=current_input_line)
+    c = wait_char()
+    if c == None:
+      continue
+    elif c.isdigit() or c == " ":
       episode = episode + c
     elif c == "KEY_BACKSPACE":
       episode = episode[:-1]
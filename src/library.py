@@ -0,0 +1,125 @@
+#! /usr/bin/env python3
+
+import os
+import time
+import collections
+import concurrent.futures
+import find
+
+roots_var = "PLAY_EPISODE_ROOTS"
+workers_var = "PLAY_EPISODE_SCAN_WORKERS"
+max_workers = 2
+
+RootScan = collections.namedtuple("RootScan",
+                                  ["root", "seconds", "directories", "error"])
+
+def get_roots(entries = ()):
+  """Gets the roots of the library.
+
+  The roots are read from the environment variable "PLAY_EPISODE_ROOTS",
+  a list of paths separated by os.pathsep; if it isn't set, the paths of
+  "entries" are used. Roots contained in another root are dropped, as
+  they're scanned with it.
+
+  Args:
+    entries: Optional. The entries whose paths are used as roots if
+             "PLAY_EPISODE_ROOTS" isn't set.
+
+  Returns:
+    A sorted list of absolute paths.
+  """
+  var = os.environ.get(roots_var)
+  if var:
+    paths = [p for p in var.split(os.pathsep) if p]
+  else:
+    paths = [entry.path for entry in entries]
+  roots = []
+  for path in sorted(set(os.path.abspath(p) for p in paths)):
+    if not any((path + os.sep).startswith(root.rstrip(os.sep) + os.sep)
+               for root in roots):
+      roots.append(path)
+  return roots
+
+def scan_root(root):
+  """Walks a root recursively, indexing every directory with episodes.
+
+  Args:
+    root: The path of the directory to walk.
+
+  Raises:
+    OSError: The root couldn't be accessed
+
+  Returns:
+    A dictionary mapping the path of each directory containing at least an
+    episode to a tuple (signature, episodes), as in find.Index.
+  """
+  found = {}
+  pending = [root]
+  while pending:
+    directory = pending.pop()
+    try:
+      (signature, episodes, subdirs) = find.read_directory(directory)
+    except OSError:
+      if directory == root:
+        raise
+      continue
+    pending.extend(subdirs)
+    if episodes:
+      found[directory] = (signature, episodes)
+  return found
+
+def _timed_scan(root):
+  start = time.monotonic()
+  try:
+    found = scan_root(root)
+  except OSError as e:
+    return (RootScan(root, time.monotonic() - start, 0, e), {})
+  return (RootScan(root, time.monotonic() - start, len(found), None), found)
+
+def scan(roots, workers = None, index = None):
+  """Scans the roots of the library, and adds them to an episode index.
+
+  Every root is walked in a pool of at most "workers" threads, so that
+  slow mounts overlap, without having more than "workers" roots read at
+  the same time. The results are merged in "index", which is then saved
+  once, so that following calls to find.find_file() don't need to list
+  the scanned directories.
+
+  Args:
+    roots: The paths of the roots to scan.
+    workers: Optional. The maximum number of roots to scan concurrently.
+             Default value: the environment variable
+             "PLAY_EPISODE_SCAN_WORKERS" if set, "max_workers" otherwise.
+    index: Optional. The find.Index to update. Default value: find.index.
+
+  Returns:
+    A list of RootScan tuples, one for each root, in the same order as
+    "roots": "seconds" is the time spent scanning the root, "directories"
+    the number of directories with episodes found in it and "error" the
+    OSError raised if the root couldn't be accessed, or None.
+  """
+  if workers == None:
+    workers = int(os.environ.get(workers_var, max_workers))
+  if index == None:
+    index = find.index
+  index.load()
+  results = []
+  with concurrent.futures.ThreadPoolExecutor(max(workers, 1)) as pool:
+    for (result, found) in pool.map(_timed_scan, roots):
+      index.update(found)
+      results.append(result)
+  try:
+    index.save_index()
+  except IOError:
+    pass
+  return results
+
+if __name__ == "__main__":
+  import data
+  entries = data.Data()
+  entries.get_data()
+  for result in scan(get_roots(entries)):
+    print("{:8.3f}s {:6d} {}{}".format(result.seconds, result.directories,
+                                       result.root,
+                                       " ({})".format(result.error)
+                                       if result.error else ""))
@@ -1,8 +1,8 @@
 #! /usr/bin/env python3
 
-from data import Data
-import interface, find, play
-import sys
+from data import Entry, EntriesChanged, open_data, get_socket_path
+import interface
+import sys, os, time
 
 class ChooseAction(Exception):
   def __init__(self, action, episode_name=None, index=-1):
@@ -13,25 +13,61 @@ class ChooseAction(Exception):
   def __str__(self):
     return repr(self.action)
 
+choose_title = "Choose an episode"
+#Shown before each entry, by availability of its episode; None is unknown
+markers = {None: "  ", "available": "+ ", "missing": "- ", "offline": "? "}
+
 def name_from_entry(entry):
-    return "{0} - {1}x{2}".format(entry["name"],
-                                  entry["season"], entry["episode"])
+    return "{0} - {1:02d}x{2:02d}".format(entry.name,
+                                          entry.season, entry.episode)
+
+def choice_from_entry(entry, state = None):
+  return markers[state] + name_from_entry(entry)
+
+def check_entries(checker, entries, indices, choices):
+  """Schedules the availability check of some entries.
 
-def handle_arrow_keys(entries, index, change, choices):
+  The markers in "choices" are updated by the interface thread as the
+  results come in; a result is dropped if its entry changed meanwhile.
+  """
+  def update(index, entry, state):
+    if index < len(entries) and entries[index] == entry:
+      choices[index] = choice_from_entry(entry, state)
+  def report(index, entry, state):
+    interface.call_soon(update, index, entry, state)
+  checker.check(((i, Entry(entries[i].name, entries[i].season,
+                           entries[i].episode, entries[i].path))
+                 for i in indices), report)
+
+def handle_arrow_keys(entries, index, change, choices, checker = None):
   if 0 <= index < len(entries):
-    entries.change_episode(index, change)
-    choices[index] = name_from_entry(entries[index])
+    #only the index already in memory is used, so that a key never waits
+    #for the disk
+    try:
+      entries.step_episode(index, change, cached=True)
+    except EntriesChanged:
+      raise ChooseAction("reload")
+    entries.save_data()
+    choices[index] = choice_from_entry(entries[index])
+    if checker != None:
+      check_entries(checker, entries, [index], choices)
 
-def choose_episode(entries):
-  choices = [name_from_entry(x) for x in entries]
-  title = "Choose an episode"
+def choose_episode(entries, checker = None):
+  import search
+  choices = [choice_from_entry(x) for x in entries]
+  title = choose_title
   index = 0
-  handle_left = lambda x,y: handle_arrow_keys(entries, y, -1, x)
-  handle_right = lambda x,y: handle_arrow_keys(entries, y, +1, x)
+  handle_left = lambda x,y: handle_arrow_keys(entries, y, -1, x, checker)
+  handle_right = lambda x,y: handle_arrow_keys(entries, y, +1, x, checker)
   handlers = {"KEY_LEFT" : handle_left, "KEY_RIGHT" : handle_right}
+  names = search.NameIndex([x.name for x in entries])
+  interface.background(names.build)
+  if checker != None:
+    check_entries(checker, entries, range(len(entries)), choices)
   while True:
     (index,key,new_input) = interface.get_choice(title, choices, True,
-                                                 i=index, handlers=handlers)
+                                                 i=index, handlers=handlers,
+                                                 search=names.search)
     if key == "\n" or key == "KEY_ENTER":
       break
     #elif key == "KEY_LEFT" and index != -1:
@@ -68,15 +104,78 @@ def yes_or_no(wait_time):
       elif index == 2:
         return "Repeat"
 
-if __name__ == "__main__":
+def process_age():
+  """Returns the seconds elapsed since the process started, or None.
+
+  The value is read from /proc, so it includes the startup of the
+  interpreter, with the resolution of a clock tick.
+  """
+  try:
+    with open("/proc/self/stat") as f:
+      fields = f.read().rsplit(")", 1)[1].split()
+    with open("/proc/uptime") as f:
+      uptime = float(f.read().split()[0])
+  except (IOError, IndexError, ValueError):
+    return None
+  return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+
+def print_startup_times(marks, age):
+  """Prints the time spent in each startup phase.
+
+  Args:
+    marks: A list of tuples (phase, time.perf_counter() at its end), with
+           a first tuple for the start of main().
+    age: The age of the process at the start of main(), or None.
+  """
+  if age != None:
+    print("{:>20}: {:7.1f} ms".format("interpreter", age * 1000))
+  for (phase, end), (_, begin) in zip(marks[1:], marks):
+    print("{:>20}: {:7.1f} ms".format(phase, (end - begin) * 1000))
+  total = marks[-1][1] - marks[0][1] + (age or 0)
+  print("{:>20}: {:7.1f} ms".format("total", total * 1000))
+
+def main(startup_time = False):
+  """Runs the program.
+
+  If the daemon (see daemon.py) is running, the data is kept and the
+  episodes are looked up by the daemon; otherwise, they're read here.
+
+  Args:
+    startup_time: Optional. If True, exits as soon as the menu is drawn,
+                  printing how long each startup phase took.
+  """
+  marks = [("start", time.perf_counter())]
+  age = process_age() if startup_time else None
   key = ""
+  entries = None
+  if os.path.exists(get_socket_path()):
+    import daemon
+    entries = daemon.connect()
+  if entries == None:
+    entries = open_data()
   try:
-    entries = Data()
     entries.get_data()
+    marks.append(("get_data", time.perf_counter()))
     interface.start()
+    marks.append(("interface.start", time.perf_counter()))
+    if startup_time:
+      interface.Menu(choose_title).draw([choice_from_entry(x)
+                                         for x in entries] + [""], high=0)
+      marks.append(("menu drawn", time.perf_counter()))
+      return
+    if os.environ.get("PLAY_EPISODE_ROOTS"):
+      import library
+      interface.background(library.scan, library.get_roots())
+    if os.environ.get("PLAY_EPISODE_WATCH"):
+      import watch
+      interface.background(watch.start)
+    import availability, find
+    #a daemon.RemoteData looks up the episodes in the daemon
+    finder = getattr(entries, "finder", find)
+    checker = availability.Checker(finder=finder)
     while True:
       try:
-        (entry_index,new_input)=choose_episode(entries)
+        (entry_index,new_input)=choose_episode(entries, checker)
       except ChooseAction as e:
         if e.action == "save":
           entries.save_data()
@@ -86,39 +185,64 @@ if __name__ == "__main__":
         elif e.action == "delete":
           entries.delete_entry(e.index)
           continue
+        elif e.action == "reload":
+          #the entries were changed by another program
+          continue
 
       if entry_index == len(entries):
         (season,episode) = interface.get_season_episode()
         entries.add_entry(new_input, season, episode)
         continue
 
+      import history, play, prefetch
       while True:
         try:
           episode = entries[entry_index]
-          video_path = find.find_file(episode)
+          (video_path, subtitle) = finder.find_file(episode, True)
         except find.NotFoundError:
           interface.text_screen("File not found", True)
           break
         else:
             text = ["Enjoy the video!",\
-                    "({} - {}x{})".format(episode["name"],
-                                                 episode["season"],
-                                                 episode["episode"])]
+                    "({})".format(name_from_entry(episode))]
             text=" ".join(text)
             interface.text_screen(text, False)
             #interface.text_screen("Enjoy the video!", False)
+            prefetch.start(episode, finder=finder)
+            started = time.monotonic()
             play.play_video(video_path, "mplayer", "-zoom", "-ao", "alsa",\
-                                                   "-fs", "-slave")
-            entries.change_episode(entry_index,1)
+                                                   "-fs", "-slave",
+                            subtitle=subtitle)
+            try:
+              history.get_history().record(episode,
+                                           time.monotonic() - started)
+            except OSError:
+              pass
+            played = (episode.season, episode.episode)
+            try:
+              entries.step_episode(entry_index, 1)
+            except EntriesChanged:
+              #another program deleted the entry: back to the menu
+              break
             try:
               answ = yes_or_no(600) #wait up to 60 seconds for an answer
             except interface.TimeError:
               sys.exit(2)
             if answ == "Repeat":
-                entries.change_episode(entry_index,-1)
+              try:
+                entries.set_episode(entry_index, *played)
+              except EntriesChanged:
+                break
             entries.save_data() #if an answer was given, save the current
                                 #data
             if answ == "No":
                 break
   finally:
+    entries.wait_compaction()
+    entries.save_cache()
     interface.close()
+    if startup_time:
+      print_startup_times(marks, age)
+
+if __name__ == "__main__":
+  sys.exit(main("--startup-time" in sys.argv[1:]))
@@ -1,14 +1,198 @@
 #! /usr/bin/env python3
 
-import os, subprocess
+import os, subprocess, threading, atexit, time
+import tracing
 
+#Lines printed by mplayer when it's done with a file, or when it's asked
+#for the file played while there's none
+_end_markers = ("EOF code:", "Failed to open",
+                "ANS_ERROR=PROPERTY_UNAVAILABLE")
+#Seconds between the checks that the player is still playing a file
+check_interval = 5
+#Asks for the file played, without unpausing it
+_check_command = "pausing_keep_force get_property path"
+
+class Player:
+  """A player process kept alive between episodes.
+
+  The player is started in slave and idle mode, so that it waits for
+  commands on its standard input instead of quitting at the end of each
+  file. Videos are played by sending it "loadfile", which avoids starting
+  a new process (and initializing codecs and video output again) for each
+  episode. If the player quits (e.g. the user pressed "q"), a new one is
+  started at the next call to play().
+
+  Each process has its own "finished" event, so that the end of a process
+  that quit can't be taken for the end of a video played by the next one.
+  The end of a video is told by the lines mplayer prints, its standard
+  error included, and by the process exiting; as a file that can't be
+  played may not print any of them, while waiting the player is also
+  asked every "check_interval" seconds whether it's still playing one.
+
+  Attributes:
+    player: The name of the executable of the player.
+    opt: The options passed to the player.
+    suppress_output: If True, the standard error of the player is
+                     suppressed.
+    process: The running player process, or None.
+    finished: The event set when the video of "process" ends.
+  """
+  def __init__(self, player = "mplayer", *opt, suppress_output = True):
+    self.player = player
+    self.opt = [o for o in opt if o not in ("-slave", "-idle")]
+    self.suppress_output = suppress_output
+    self.process = None
+    self.finished = threading.Event()
+    self.finished.set()
+
+  def alive(self):
+    """Returns True if the player process is running."""
+    return self.process != None and self.process.poll() == None
+
+  def start(self):
+    """Starts the player process, if it isn't already running."""
+    if self.alive():
+      return
+    arg = [self.player, "-slave", "-idle", "-msglevel", "global=6"] +\
+          self.opt
+    with tracing.span("play.spawn"):
+      self.process = subprocess.Popen(arg, stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT
+                                             if self.suppress_output
+                                             else None,
+                                      universal_newlines=True, bufsize=1)
+    self.finished = threading.Event()
+    self.finished.set()
+    threading.Thread(target=self._read, args=(self.process, self.finished),
+                     daemon=True).start()
+
+  def _read(self, process, finished):
+    for line in process.stdout:
+      if line.startswith(_end_markers):
+        finished.set()
+    process.wait()
+    finished.set()
+
+  def send(self, command, *args):
+    """Sends a command to the player.
+
+    Args:
+      command: The slave mode command.
+      *args: The arguments of the command; strings are quoted.
+
+    Raises:
+      OSError: The player isn't running
+    """
+    quote = lambda x: '"{}"'.format(x.replace("\\", "\\\\")
+                                     .replace('"', '\\"'))
+    line = " ".join([command] + [quote(a) if isinstance(a, str) else str(a)
+                                 for a in args])
+    try:
+      self.process.stdin.write(line + "\n")
+      self.process.stdin.flush()
+    except (AttributeError, ValueError) as e:
+      raise OSError("The player isn't running") from e
+
+  def play(self, video_path, subtitle = None):
+    """Starts playing a video, without waiting for it to end.
+
+    Args:
+      video_path: A string with the path of the video to be played.
+      subtitle: Optional. If it's set to a string, the subtitle to load.
+
+    Raises:
+      OSError: The player couldn't be started
+    """
+    for retry in (True, False):
+      self.start()
+      self.finished.clear()
+      try:
+        self.send("loadfile", video_path)
+        if subtitle != None:
+          self.send("sub_load", subtitle)
+        return
+      except OSError:
+        #the player quit in the meantime: start a new one
+        self.finished.set()
+        if not retry:
+          raise
+
+  def playing(self):
+    """Returns True if a video is being played."""
+    return not self.finished.is_set()
+
+  def wait(self, timeout = None):
+    """Waits for the current video to end.
+
+    Args:
+      timeout: Optional. The maximum number of seconds to wait.
+
+    Returns:
+      True if the video ended, False if "timeout" expired.
+    """
+    finished = self.finished
+    if timeout != None:
+      deadline = time.monotonic() + timeout
+    while True:
+      interval = check_interval
+      if timeout != None:
+        interval = min(interval, deadline - time.monotonic())
+      if finished.wait(max(interval, 0)):
+        return True
+      if timeout != None and time.monotonic() >= deadline:
+        return False
+      if not self.alive():
+        return True
+      try:
+        self.send(_check_command)
+      except OSError:
+        return True
+
+  def quit(self):
+    """Quits the player process, if running."""
+    if self.alive():
+      try:
+        self.send("quit")
+      except OSError:
+        pass
+      self.process.wait()
+    self.process = None
+    self.finished.set()
+
+_players = {}
+
+def get_player(player = "mplayer", *opt, suppress_output = True):
+  """Returns the Player for the given executable and options.
+
+  The player is created at the first call, and reused afterwards.
+  """
+  key = (player, opt, suppress_output)
+  if key not in _players:
+    _players[key] = Player(player, *opt, suppress_output=suppress_output)
+  return _players[key]
+
+def close():
+  """Quits all the players started by play_video().
+
+  It's called automatically at exit.
+  """
+  for player in _players.values():
+    player.quit()
+  _players.clear()
+
+atexit.register(close)
+
+@tracing.traced("play.play_video")
 def play_video(video_path, player="mplayer", *opt,
                subtitle = None, sub_op = "-sub",
                suppress_output = True):
   """Plays a video
      
   This function plays a video, with an optional subtitle,
-  with the player specified in "player".
+  with the player specified in "player", and waits for it to end.
+  If the player is mplayer, a Player is kept alive between calls, and
+  the video is loaded in it.
 
   Args:
     video_path: A string with the path of the video to be played.
@@ -22,6 +206,14 @@ def play_video(video_path, player="mplayer", *opt,
                      standard error are suppressed.
   """
 
+  if os.path.basename(player) == "mplayer":
+    controller = get_player(player, *opt, suppress_output=suppress_output)
+    with tracing.span("play.load"):
+      controller.play(video_path, subtitle)
+    with tracing.span("play.wait"):
+      controller.wait()
+    return
+
   if subtitle != None:
     sub_part = [sub_op] + [subtitle]
   else:
@@ -0,0 +1,107 @@
+#! /usr/bin/env python3
+
+import os
+import threading
+import find
+import data
+
+size_var = "PLAY_EPISODE_PREFETCH_SIZE"
+nice_var = "PLAY_EPISODE_PREFETCH_NICE"
+prefetch_size = 32 * 1024 * 1024
+prefetch_nice = 19
+chunk_size = 1024 * 1024
+
+def next_entry(entry, finder = find):
+  """Returns a copy of "entry" pointing to the following episode.
+
+  The following episode is the next one on disk, as in
+  find.step_episode(), even in the next season.
+
+  Args:
+    entry: The entry, as in find.find_file().
+    finder: Optional. The find module, or an object with its interface
+            such as a daemon.RemoteFinder, used to look up the episode.
+  """
+  try:
+    found = finder.step_episode(entry, 1)
+  except OSError:
+    found = None
+  if found == None:
+    found = (entry.season, entry.episode + 1)
+  return data.Entry(entry.name, found[0], found[1], entry.path)
+
+def warm(path, size):
+  """Loads the beginning of a file in the page cache.
+
+  The kernel is asked to read ahead the first "size" bytes of the file,
+  which are then read, as some network filesystems ignore the advice.
+
+  Args:
+    path: The path of the file.
+    size: The number of bytes to load.
+
+  Raises:
+    OSError: The file couldn't be read
+  """
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    if hasattr(os, "posix_fadvise"):
+      os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+    while size > 0:
+      chunk = os.read(fd, min(size, chunk_size))
+      if not chunk:
+        break
+      size -= len(chunk)
+  finally:
+    os.close(fd)
+
+def _lower_priority(nice):
+  #on Linux the niceness is per thread, and the I/O priority of the
+  #best-effort class follows it
+  try:
+    os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+  except (AttributeError, OSError):
+    pass
+
+def _prefetch(entry, size, nice, finder):
+  _lower_priority(nice)
+  try:
+    path = finder.find_file(next_entry(entry, finder))
+    warm(path, size)
+  except (find.NotFoundError, OSError):
+    pass
+
+def start(entry, size = None, nice = None, finder = find):
+  """Prefetches the episode following "entry" in the background.
+
+  A new thread finds the next episode with next_entry(), looks it up with
+  finder.find_file(), so that its directory is indexed, and warms the
+  beginning of the file with warm(); nothing touches the disk before the
+  thread starts. The thread works on a copy of "entry", and runs with a
+  lower priority, so that it doesn't get in the way of the episode being
+  played.
+
+  Args:
+    entry: The entry currently played, as in find.find_file().
+    size: Optional. The number of bytes to warm. Default value: the
+          environment variable "PLAY_EPISODE_PREFETCH_SIZE" if set,
+          "prefetch_size" otherwise.
+    nice: Optional. The niceness of the thread. Default value: the
+          environment variable "PLAY_EPISODE_PREFETCH_NICE" if set,
+          "prefetch_nice" otherwise.
+    finder: Optional. As in next_entry().
+
+  Returns:
+    The started thread.
+  """
+  if size == None:
+    size = int(os.environ.get(size_var, prefetch_size))
+  if nice == None:
+    nice = int(os.environ.get(nice_var, prefetch_nice))
+  #the thread works on a copy, as the entry is stepped while it runs
+  entry = data.Entry(entry.name, entry.season, entry.episode, entry.path)
+  thread = threading.Thread(target=_prefetch,
+                            args=(entry, size, nice, finder),
+                            daemon=True)
+  thread.start()
+  return thread
@@ -0,0 +1,274 @@
+#! /usr/bin/env python3
+
+import os
+import queue
+import threading
+import subprocess
+import data
+import find
+
+metadata_name = "play_episode.metadata"
+metadata_version = 1
+workers_var = "PLAY_EPISODE_PROBE_WORKERS"
+policy_var = "PLAY_EPISODE_RANK"
+max_workers = 2
+default_policy = "height,ext"
+#Seconds after which a probe is abandoned, as for a file on a dead mount
+probe_timeout = 30
+command = ["mplayer", "-identify", "-frames", "0", "-vo", "null",
+           "-ao", "null", "-nolirc", "-msglevel", "all=0:identify=4"]
+#The lines of "mplayer -identify" kept, by the key they're stored in
+_fields = {"ID_VIDEO_WIDTH": ("width", int),
+           "ID_VIDEO_HEIGHT": ("height", int),
+           "ID_LENGTH": ("length", float),
+           "ID_VIDEO_FORMAT": ("video", str),
+           "ID_AUDIO_CODEC": ("audio", str)}
+
+class Metadata(data.PickledCache):
+  """Persistent cache of the metadata of videos.
+
+  Maps the (device, inode) of a file to a tuple (size, mtime, metadata);
+  the metadata is used only while the size and the mtime of the file don't
+  change.
+
+  Attributes:
+    path: The file where the cache is saved.
+    lock: The lock held while the cache is changed, loaded or saved.
+  """
+  name = metadata_name
+  version = metadata_version
+
+  def get_metadata(self):
+    """Loads the cache saved in "path", if it can be read."""
+    self.read()
+
+  def save_metadata(self):
+    """Saves the cache to "path", through a temporary file.
+
+    Raises:
+      IOError: The cache couldn't be saved
+    """
+    self.write()
+
+  def lookup(self, st):
+    """Returns the metadata of the file with the given os.stat_result, or
+    None if it isn't known."""
+    cached = self.get((st.st_dev, st.st_ino))
+    if cached != None and cached[:2] == (st.st_size, st.st_mtime_ns):
+      return cached[2]
+    return None
+
+  def store(self, st, metadata):
+    with self.lock:
+      self[(st.st_dev, st.st_ino)] = (st.st_size, st.st_mtime_ns, metadata)
+
+def probe(path, timeout = probe_timeout):
+  """Reads the metadata of a video with "mplayer -identify".
+
+  Args:
+    path: The absolute path of the video.
+    timeout: Optional. The seconds after which the probe is abandoned.
+
+  Raises:
+    OSError: mplayer couldn't be run
+
+  Returns:
+    A dictionary with the keys in "_fields" that could be read: "width",
+    "height" and "length" (in seconds) of the video, "video" and "audio"
+    codecs. It's empty if the file couldn't be read.
+  """
+  try:
+    output = subprocess.run(command + [path], stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, timeout=timeout,
+                            universal_newlines=True, errors="replace").stdout
+  except subprocess.TimeoutExpired:
+    return {}
+  metadata = {}
+  for line in output.splitlines():
+    (field, _, value) = line.partition("=")
+    if field in _fields:
+      (key, convert) = _fields[field]
+      try:
+        metadata[key] = convert(value.strip())
+      except ValueError:
+        pass
+  return metadata
+
+class Prober:
+  """Probes videos in the background, caching their metadata.
+
+  At most "workers" probes run at the same time, each in its own mplayer
+  process, driven by a daemon thread so that a probe stuck on a dead
+  mount doesn't keep the program from exiting. The cache is saved each
+  time the queue of videos to probe empties. If mplayer can't be run,
+  probing stops for good.
+
+  Attributes:
+    metadata: The Metadata cache.
+    available: False once mplayer couldn't be run.
+  """
+  def __init__(self, metadata, workers = None):
+    if workers == None:
+      workers = int(os.environ.get(workers_var, max_workers))
+    self.metadata = metadata
+    self.workers = max(workers, 1)
+    self.available = True
+    self._queue = queue.Queue()
+    self._pending = set()
+    self._lock = threading.Lock()
+    self._threads = []
+
+  def schedule(self, paths):
+    """Schedules the probe of some videos, returning immediately.
+
+    Args:
+      paths: The absolute paths of the videos; the ones already scheduled
+             are skipped.
+    """
+    with self._lock:
+      if not self.available:
+        return
+      for path in paths:
+        if path not in self._pending:
+          self._pending.add(path)
+          self._queue.put(path)
+      while len(self._threads) < min(self.workers, len(self._pending)):
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+  def join(self):
+    """Waits for all the scheduled probes to end."""
+    self._queue.join()
+
+  def _run(self):
+    while True:
+      path = self._queue.get()
+      try:
+        self._probe(path)
+      finally:
+        with self._lock:
+          self._pending.discard(path)
+          drained = not self._pending
+        if drained:
+          try:
+            self.metadata.save_metadata()
+          except IOError:
+            pass
+        self._queue.task_done()
+
+  def _probe(self, path):
+    if not self.available:
+      return
+    try:
+      st = os.stat(path)
+      if self.metadata.lookup(st) != None:
+        return
+      metadata = probe(path)
+    except FileNotFoundError:
+      if os.path.exists(path):
+        #the file is there, so mplayer is missing
+        self.available = False
+      return
+    except OSError:
+      return
+    self.metadata.store(st, metadata)
+
+_prober = None
+_prober_lock = threading.Lock()
+
+def get_prober():
+  """Returns the Prober shared by the program, with the cache loaded."""
+  global _prober
+  with _prober_lock:
+    if _prober == None:
+      metadata = Metadata()
+      metadata.get_metadata()
+      _prober = Prober(metadata)
+  return _prober
+
+def get_policy():
+  """Returns the ranking policy.
+
+  It's read from the environment variable "PLAY_EPISODE_RANK" if set,
+  "default_policy" otherwise: a comma separated list of criteria, the
+  first deciding unless it's a tie. A criterion is one of:
+    height, width, length, size: bigger is better; "-height" and so on
+      prefer smaller.
+    ext: the order of find.set_extensions; "-ext" reverses it.
+    video=CODEC, audio=CODEC: prefer the given codec (e.g. "video=h264").
+
+  Returns:
+    A list of criteria, as strings.
+  """
+  policy = os.environ.get(policy_var) or default_policy
+  return [c.strip().lower() for c in policy.split(",") if c.strip()]
+
+def rank(paths, policy = None):
+  """Ranks candidate videos of an episode by their metadata.
+
+  Only the cached metadata is used: videos never probed are scheduled to
+  be probed in the background, and None is returned, so that ranking
+  never waits for a probe.
+
+  Args:
+    paths: The absolute paths of the candidates.
+    policy: Optional. The criteria, as returned by get_policy().
+
+  Returns:
+    The sorted list of the paths, best first, or None if the metadata of
+    some of them isn't known yet.
+  """
+  if policy == None:
+    policy = get_policy()
+  prober = get_prober()
+  known = {}
+  missing = []
+  for path in paths:
+    try:
+      st = os.stat(path)
+    except OSError:
+      missing.append(path)
+      continue
+    metadata = prober.metadata.lookup(st)
+    if metadata == None:
+      missing.append(path)
+    else:
+      known[path] = (st, metadata)
+  if missing:
+    prober.schedule(missing)
+    return None
+  return sorted(paths, key=lambda p: tuple(_score(c, p, *known[p])
+                                           for c in policy) + (p,))
+
+def _score(criterion, path, st, metadata):
+  reverse = criterion.startswith("-")
+  name = criterion.lstrip("-")
+  if name == "ext":
+    ext = path.rpartition(".")[2].lower()
+    exts = find.set_extensions
+    value = exts.index(ext) if ext in exts else len(exts)
+    return -value if reverse else value
+  if "=" in name:
+    (field, _, wanted) = name.partition("=")
+    return 0 if str(metadata.get(field, "")).lower() == wanted else 1
+  value = st.st_size if name == "size" else metadata.get(name, 0)
+  return value if reverse else -value
+
+if __name__ == "__main__":
+  #probes the videos of the episodes with more than one candidate, so that
+  #play_episode finds the cache warm
+  index = find.index
+  index.load()
+  paths = [os.path.join(directory, name)
+           for (directory, (signature, episodes)) in list(index.items())
+           for found in episodes.values()
+           for names in found.get("videos", {}).values()
+           for name in names]
+  prober = get_prober()
+  prober.schedule(sorted(set(paths)))
+  prober.join()
+  if not prober.available:
+    print("mplayer couldn't be run")
+  print("{} videos probed or already known".format(len(set(paths))))
@@ -0,0 +1,130 @@
+#! /usr/bin/env python3
+
+"""Replays scripted keys through the menus, without a terminal.
+
+Prints, for each scenario, the percentiles of the time spent handling a
+key (from the moment it's read to the moment the next one is requested)
+and the cells and bytes written to the screen per key.
+"""
+
+import os
+import argparse
+import tempfile
+import data
+import find
+import interface
+import fakescreen
+import main
+
+class _Entries(data.Data):
+  #changes are kept in memory only
+  def save_data(self):
+    del self.pending[:]
+
+def make_entries(n_entries, path = "/tmp"):
+  """Returns a Data with "n_entries" synthetic series in "path", not
+  saved."""
+  entries = _Entries()
+  for i in range(n_entries):
+    entries.append(data.Entry("Series {:05d}".format(i), i % 9 + 1,
+                              i % 24 + 1, path))
+  return entries
+
+def make_library(root, seasons = 9, episodes = 24):
+  """Creates empty episodes in "root", indexing them in a new find.index.
+
+  The names don't contain the name of any series (e.g. "1x02 Title.avi"),
+  so the arrow keys step through all of them.
+  """
+  for season in range(1, seasons + 1):
+    for episode in range(1, episodes + 1):
+      name = "{}x{:02d} Title.avi".format(season, episode)
+      open(os.path.join(root, name), "w").close()
+  find.index = find.Index(os.path.join(root, find.index_name))
+  find.index.episodes(root)
+
+def replay(function, keys, lines = 24, cols = 80):
+  """Calls "function" with the interface reading "keys".
+
+  Args:
+    function: The function to call, e.g. a lambda calling
+              main.choose_episode().
+    keys: The keys to feed, as returned by curses' getkey() (e.g.
+          "KEY_DOWN", "\\n"); fakescreen.TIMEOUT stands for a key not
+          pressed in time.
+    lines: Optional. The number of lines of the fake screen.
+    cols: Optional. The number of columns of the fake screen.
+
+  Returns:
+    A tuple with the FakeScreen used as the first element, and the value
+    returned by "function" (or None, if it ran out of keys) as the second.
+  """
+  screen = fakescreen.FakeScreen(keys, lines, cols)
+  old_backend = interface.backend
+  interface.use_backend(screen)
+  result = None
+  try:
+    interface.start()
+    try:
+      result = function()
+    except fakescreen.ReplayEnd:
+      pass
+    screen.finish()
+  finally:
+    interface.close()
+    interface.use_backend(old_backend)
+  return (screen, result)
+
+def percentile(values, fraction):
+  values = sorted(values)
+  return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def report(name, screen):
+  """Prints the statistics of the keys replayed on "screen"."""
+  strokes = screen.keystrokes
+  if not strokes:
+    print("{}: no keys".format(name))
+    return
+  times = [k.seconds * 1000 for k in strokes]
+  print("{} ({} keys)".format(name, len(strokes)))
+  print("  latency ms: p50 {:.3f}  p90 {:.3f}  p99 {:.3f}  max {:.3f}".format(
+    percentile(times, 0.5), percentile(times, 0.9), percentile(times, 0.99),
+    max(times)))
+  print("  per key:    {:.1f} cells  {:.1f} bytes".format(
+    sum(k.cells for k in strokes) / len(strokes),
+    sum(k.bytes for k in strokes) / len(strokes)))
+
+def scenarios(n_entries, path = "/tmp"):
+  """Returns the scenarios to replay, as (name, function, keys) tuples.
+
+  The entries of the menus are in "path".
+  """
+  moves = ["KEY_DOWN"] * 30 + ["KEY_NPAGE"] * 5 + ["KEY_UP"] * 10 +\
+          ["KEY_RIGHT", "KEY_LEFT"] * 10 + ["KEY_END", "KEY_HOME"]
+  typing = ["KEY_END"] + list("series 0012") + ["KEY_BACKSPACE"] * 4 +\
+           ["KEY_UP", "\n"]
+  new_entry = ["KEY_END"] + list("new series") + ["\n"] +\
+              list("12") + ["\n"] + list("3") + ["\n"]
+  def choose():
+    return main.choose_episode(make_entries(n_entries, path))
+  def add():
+    (index, name) = main.choose_episode(make_entries(n_entries, path))
+    return (name, interface.get_season_episode())
+  return [("choose_episode, moving", choose, moves + ["\n"]),
+          ("choose_episode, typing", choose, typing),
+          ("choose_episode, new entry", add, new_entry),
+          ("yes_or_no", lambda: main.yes_or_no(600),
+           ["KEY_DOWN", "KEY_DOWN", "KEY_UP", "\n"])]
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--entries", type=int, default=1000,
+                      help="number of series in the menu")
+  parser.add_argument("--lines", type=int, default=24)
+  parser.add_argument("--cols", type=int, default=80)
+  args = parser.parse_args()
+  with tempfile.TemporaryDirectory() as root:
+    make_library(root)
+    for (name, function, keys) in scenarios(args.entries, root):
+      (screen, result) = replay(function, keys, args.lines, args.cols)
+      report(name, screen)
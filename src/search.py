@@ -0,0 +1,99 @@
+#! /usr/bin/env python3
+
+import re
+import collections
+import threading
+
+gram_size = 3
+
+_separators = re.compile(r"[\W_]+")
+
+def normalize(text):
+  """Normalizes a name for searching.
+
+  The name is lowercased and any character that isn't a letter or a digit
+  is dropped, so that "gameof" matches "Game of Thrones".
+  """
+  return _separators.sub("", text.lower())
+
+class NameIndex:
+  """An n-gram index over a list of names, for type-ahead searching.
+
+  A query matches a name if, once both are normalized, the query is
+  contained in the name. Every n-gram of the names, up to "gram_size"
+  characters, is indexed: a short query is answered by its own postings,
+  a longer one by intersecting the postings of its n-grams. When a query
+  extends the previous one, as it happens while typing, the previous
+  results are narrowed instead of searching the whole index again.
+
+  Attributes:
+    names: The normalized names.
+  """
+  def __init__(self, names):
+    self.names = [normalize(name) for name in names]
+    self.grams = None
+    self.lock = threading.Lock()
+    self.last_query = None
+    self.last_result = None
+
+  def build(self):
+    """Builds the index, if it wasn't already built.
+
+    It can be called from a background thread, so that the index is
+    ready by the time the first query is made.
+    """
+    with self.lock:
+      if self.grams != None:
+        return
+      grams = collections.defaultdict(set)
+      for i, name in enumerate(self.names):
+        for gram in {name[start:start+size]
+                     for size in range(1, gram_size + 1)
+                     for start in range(len(name) - size + 1)}:
+          grams[gram].add(i)
+      self.grams = grams
+
+  def search(self, text):
+    """Returns the indices of the names matching "text".
+
+    Args:
+      text: The query.
+
+    Returns:
+      A sorted list of indices, or None if the query is empty and every
+      name matches.
+    """
+    query = normalize(text)
+    if not query:
+      self.last_query = self.last_result = None
+      return None
+    self.build()
+    if len(query) <= gram_size:
+      result = sorted(self.grams.get(query, ()))
+    elif self.last_query != None and query.startswith(self.last_query):
+      result = [i for i in self.last_result if query in self.names[i]]
+    else:
+      postings = sorted((self.grams.get(query[start:start+gram_size], set())
+                         for start in range(len(query) - gram_size + 1)),
+                        key=len)
+      candidates = postings[0].intersection(*postings[1:])
+      result = sorted(i for i in candidates if query in self.names[i])
+    self.last_query = query
+    self.last_result = result
+    return result
+
+if __name__ == "__main__":
+  import time
+  words = ["the", "game", "of", "thrones", "breaking", "bad", "wire", "lost",
+           "house", "doctor", "who", "star", "trek", "dark", "mad", "men"]
+  names = [" ".join(words[(i * k) % len(words)] for k in (3, 5, 7)) +
+           " " + str(i) for i in range(10000)]
+  index = NameIndex(names)
+  start = time.perf_counter()
+  index.build()
+  print("build: {:.1f} ms".format((time.perf_counter() - start) * 1000))
+  for query in ("t", "th", "thr", "thro", "thrones", "thrones bad", "1234"):
+    start = time.perf_counter()
+    result = index.search(query)
+    print("{!r}: {} results in {:.3f} ms".format(
+      query, len(result), (time.perf_counter() - start) * 1000))
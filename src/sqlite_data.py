@@ -0,0 +1,216 @@
+#! /usr/bin/env python3
+
+import os
+import sqlite3
+import data
+
+db_name = "play_episode.db"
+
+_schema = """
+CREATE TABLE IF NOT EXISTS series (
+  id INTEGER PRIMARY KEY,
+  name TEXT NOT NULL,
+  season INTEGER NOT NULL,
+  episode INTEGER NOT NULL,
+  path TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS series_name ON series (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS series_path ON series (path);
+CREATE UNIQUE INDEX IF NOT EXISTS series_entry ON series (name, path);
+"""
+#Keeps the last row added for each entry, in databases created before
+#entries were unique
+_dedupe = """
+DELETE FROM series WHERE id NOT IN
+  (SELECT max(id) FROM series GROUP BY name, path);
+"""
+#Adds an entry, or changes the episode of the entry with the same name and
+#path, as data.Data does
+_upsert = """
+INSERT INTO series (name, season, episode, path) VALUES (?, ?, ?, ?)
+  ON CONFLICT (name, path) DO UPDATE
+  SET season = excluded.season, episode = excluded.episode
+"""
+
+class SqliteData:
+  """The series data, stored in a SQLite database.
+
+  Offers the same interface as data.Data: entries are accessed by index,
+  in name order, and are data.Entry objects.
+  Only the ids of the entries are read when the database is opened; each
+  entry is read the first time it's accessed, or with all the others by a
+  single query when iterating. As in data.Data, there's
+  one entry for each name and path: adding it again changes its episode.
+  Changes are made in a transaction, committed by save_data().
+
+  Attributes:
+    path: The path of the database.
+  """
+  def __init__(self, path = None):
+    if path == None:
+      path = os.environ.get("PLAY_EPISODE_DB",
+                            os.path.join(data.base_dir, db_name))
+    self.path = path
+    self.conn = None
+    self._ids = []
+    self._rows = {}
+
+  def get_data(self):
+    """Opens the database in "path", creating it if needed.
+
+    Raises:
+      sqlite3.Error: The database couldn't be opened
+    """
+    data._assure_dir(os.path.dirname(os.path.abspath(self.path)))
+    if self.conn != None:
+      self.conn.close()
+    self.conn = sqlite3.connect(self.path)
+    try:
+      self.conn.executescript(_schema)
+    except sqlite3.IntegrityError:
+      self.conn.executescript(_dedupe + _schema)
+    self._reload()
+
+  def save_data(self):
+    """Commits the changes made since the last save."""
+    self.conn.commit()
+
+  def wait_compaction(self):
+    """Present for compatibility with data.Data; nothing to wait for."""
+    pass
+
+  def save_cache(self):
+    """Present for compatibility with data.Data; rows are read lazily."""
+    pass
+
+  def change_path(self, new_path):
+    """Changes the current default path
+    """
+    self.path = new_path
+
+  def add_entry(self, name, season, episode, path = None):
+    if path == None:
+      path = os.path.abspath(os.curdir)
+    self.conn.execute(_upsert, (name, season, episode, path))
+    self._reload()
+
+  def delete_entry(self, index):
+    self.conn.execute("DELETE FROM series WHERE id = ?", (self._ids[index],))
+    self._reload()
+
+  def change_episode(self, index, shift):
+    """Changes the value of the episode of an entry
+    
+    Changes the value of the episode of the entry number "index"
+    to its old value plus "shift"; its value will always be between
+    0 and 99.
+
+    Args:
+      index: The index of the entry to change
+      shift: The value to add to the episode
+
+    Raises:
+      IndexError: No entry with the given index was found
+    """
+    row_id = self._ids[index]
+    self.conn.execute("UPDATE series SET episode = "
+                      "max(min(episode + ?, 99), 0) WHERE id = ?",
+                      (shift, row_id))
+    self._rows.pop(row_id, None)
+
+  def set_episode(self, index, season, episode):
+    """Sets the season and the episode of an entry.
+
+    Args:
+      index: The index of the entry to change
+      season: The new season
+      episode: The new episode
+
+    Raises:
+      IndexError: No entry with the given index was found
+    """
+    row_id = self._ids[index]
+    self.conn.execute("UPDATE series SET season = ?, episode = ? "
+                      "WHERE id = ?", (season, episode, row_id))
+    self._rows.pop(row_id, None)
+
+  def step_episode(self, index, step, cached = False):
+    """Moves an entry to the episode "step" files away on disk.
+
+    As in data.Data.step_episode().
+    """
+    data._step_episode(self, index, step, cached)
+
+  def index_of(self, name, path):
+    """Returns the index of the entry with a name and a path, or -1."""
+    row = self.conn.execute("SELECT id FROM series WHERE name = ? AND "
+                            "path = ?", (name, path)).fetchone()
+    if row == None or row[0] not in self._ids:
+      return -1
+    return self._ids.index(row[0])
+
+  def find_by_name(self, name):
+    """Returns the entries with the given name, ignoring case."""
+    return [_to_entry(row) for row in self.conn.execute(
+      "SELECT name, season, episode, path FROM series "
+      "WHERE name = ? COLLATE NOCASE", (name,))]
+
+  def find_by_path(self, path):
+    """Returns the entries stored in the given directory."""
+    return [_to_entry(row) for row in self.conn.execute(
+      "SELECT name, season, episode, path FROM series WHERE path = ?",
+      (path,))]
+
+  def import_data(self, entries):
+    """Adds the entries of a data.Data to the database, in a transaction.
+
+    Entries already in the database take the episode they have in
+    "entries", so importing the same data twice doesn't duplicate them.
+
+    Args:
+      entries: The loaded data.Data.
+    """
+    with self.conn:
+      self.conn.executemany(_upsert, ((e.name, e.season, e.episode, e.path)
+                                      for e in entries))
+    self._reload()
+
+  def _reload(self):
+    self._ids = [row[0] for row in self.conn.execute(
+      "SELECT id FROM series ORDER BY name COLLATE NOCASE, id")]
+    self._rows.clear()
+
+  def __len__(self):
+    return len(self._ids)
+
+  def __getitem__(self, index):
+    row_id = self._ids[index]
+    if row_id not in self._rows:
+      self._rows[row_id] = _to_entry(self.conn.execute(
+        "SELECT name, season, episode, path FROM series WHERE id = ?",
+        (row_id,)).fetchone())
+    return self._rows[row_id]
+
+  def __iter__(self):
+    #one query for all the entries, rather than one for each
+    ids = set(self._ids)
+    for row in self.conn.execute(
+        "SELECT id, name, season, episode, path FROM series "
+        "ORDER BY name COLLATE NOCASE, id"):
+      if row[0] in ids:
+        if row[0] not in self._rows:
+          self._rows[row[0]] = _to_entry(row[1:])
+        yield self._rows[row[0]]
+
+def _to_entry(row):
+  return data.Entry(*row)
+
+if __name__ == "__main__":
+  #imports the current data file in the database
+  entries = data.Data()
+  entries.get_data()
+  db = SqliteData()
+  db.get_data()
+  db.import_data(entries)
+  print("Imported {} entries from {} in {}".format(len(entries), entries.path,
+                                                   db.path))
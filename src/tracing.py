@@ -0,0 +1,131 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import functools
+import threading
+
+trace_var = "PLAY_EPISODE_TRACE"
+
+#The file the spans are written to; tracing is disabled if it's not set
+path = os.environ.get(trace_var)
+enabled = bool(path)
+
+_lock = threading.Lock()
+_file = None
+
+class _Span:
+  """A span being timed; see span()."""
+  __slots__ = ("name", "fields", "start")
+
+  def __init__(self, name, fields):
+    self.name = name
+    self.fields = fields
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    record(self.name, self.start, time.perf_counter() - self.start,
+           **self.fields)
+    return False
+
+class _NullSpan:
+  """The span returned by span() when tracing is disabled."""
+  __slots__ = ()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+_null_span = _NullSpan()
+
+def record(name, start, seconds, **fields):
+  """Writes a span to the trace file.
+
+  Args:
+    name: The name of the span.
+    start: The start of the span, as returned by time.perf_counter().
+    seconds: The duration of the span.
+    **fields: Any other value to write, which must be serializable as JSON.
+  """
+  global _file
+  line = dict(fields, name=name, start=start, ms=seconds * 1000,
+              thread=threading.current_thread().name)
+  with _lock:
+    if _file == None:
+      _file = open(path, "a", buffering=1)
+    _file.write(json.dumps(line) + "\n")
+
+def span(name, **fields):
+  """Returns a context manager timing a span of code.
+
+  When tracing is disabled, a shared object doing nothing is returned.
+
+  Args:
+    name: The name of the span.
+    **fields: Any other value to write with the span.
+  """
+  if not enabled:
+    return _null_span
+  return _Span(name, fields)
+
+def traced(name):
+  """Decorator recording a span for each call of a function.
+
+  When tracing is disabled, the function is returned unchanged, so that
+  there is no overhead at all.
+
+  Args:
+    name: The name of the spans.
+  """
+  def decorate(function):
+    if not enabled:
+      return function
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      with _Span(name, {}):
+        return function(*args, **kwargs)
+    return wrapper
+  return decorate
+
+def summary(lines):
+  """Summarizes the spans of a trace.
+
+  Args:
+    lines: The lines of a trace file.
+
+  Returns:
+    A list of tuples (name, count, total, mean, p50, p95, max), with the
+    times in milliseconds, sorted by decreasing total.
+  """
+  times = {}
+  for line in lines:
+    if line.strip():
+      span = json.loads(line)
+      times.setdefault(span["name"], []).append(span["ms"])
+  rows = []
+  for name, values in times.items():
+    values.sort()
+    at = lambda f: values[min(int(len(values) * f), len(values) - 1)]
+    rows.append((name, len(values), sum(values), sum(values) / len(values),
+                 at(0.5), at(0.95), values[-1]))
+  rows.sort(key=lambda row: -row[2])
+  return rows
+
+if __name__ == "__main__":
+  if len(sys.argv) != 2:
+    print("Usage: {} TRACE_FILE".format(sys.argv[0]), file=sys.stderr)
+    sys.exit(1)
+  with open(sys.argv[1]) as f:
+    rows = summary(f)
+  print("{:<28} {:>6} {:>10} {:>9} {:>9} {:>9} {:>9}".format(
+    "span", "count", "total ms", "mean", "p50", "p95", "max"))
+  for row in rows:
+    print("{:<28} {:>6} {:>10.2f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}"
+          .format(*row))
@@ -0,0 +1,345 @@
+#! /usr/bin/env python3
+
+import os
+import errno
+import struct
+import ctypes
+import ctypes.util
+import selectors
+import threading
+import collections
+import find
+
+watch_var = "PLAY_EPISODE_WATCH"
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO |\
+        IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+_event = struct.Struct("iIII")
+
+_libc = None
+
+def _get_libc():
+  global _libc
+  if _libc == None:
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+      raise OSError(errno.ENOSYS, "inotify is not available")
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    _libc = libc
+  return _libc
+
+class Watcher:
+  """Keeps an episode index up to date with inotify.
+
+  Every directory watched is listed once; after that, the creation,
+  deletion and renaming of its files are applied to the episodes cached
+  in the index as they happen, updating only the episodes they concern,
+  so that lookups always find the directory unchanged. If the queue of
+  events overflows, every directory watched is read again, as the events
+  lost can't be told. If the inotify watch limit is reached, the
+  directories that couldn't be watched are left to the usual mtime check
+  of find.Index. Subtitle folders aren't watched either: the mtime check
+  covers them.
+
+  Attributes:
+    index: The find.Index kept up to date.
+    fallback: The directories that couldn't be watched.
+  """
+  def __init__(self, index = None):
+    """Creates a watcher.
+
+    Raises:
+      OSError: inotify isn't available
+    """
+    self.index = index if index != None else find.index
+    self.fallback = set()
+    self._libc = _get_libc()
+    self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self._fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    self._wakeup = os.pipe()
+    self._requests = collections.deque()
+    self._dirs = {}
+    self._names = {}
+    self._series = {}
+    self._thread = None
+
+  def watch(self, directory):
+    """Starts watching a directory.
+
+    The directory is listed and watched by the thread of the watcher, so
+    this function returns immediately and can be called from any thread.
+    """
+    self._requests.append(directory)
+    os.write(self._wakeup[1], b"\0")
+
+  def watch_index(self):
+    """Starts watching every directory in the index."""
+    self.index.load()
+    for directory in list(self.index):
+      self.watch(directory)
+
+  def start(self):
+    """Starts the thread of the watcher."""
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  def _run(self):
+    selector = selectors.DefaultSelector()
+    selector.register(self._fd, selectors.EVENT_READ)
+    selector.register(self._wakeup[0], selectors.EVENT_READ)
+    while True:
+      for (key, events) in selector.select():
+        if key.fd == self._wakeup[0]:
+          os.read(self._wakeup[0], 4096)
+          while self._requests:
+            self._add(self._requests.popleft())
+        else:
+          self._read_events()
+
+  def _add(self, directory):
+    if directory in self._names or directory in self.fallback:
+      return
+    wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _mask)
+    if wd < 0:
+      if ctypes.get_errno() == errno.ENOSPC:
+        self.fallback.add(directory)
+      return
+    self._dirs[wd] = directory
+    if not self._scan(directory):
+      return
+    cached = self.index.get(directory)
+    if cached == None or not find._unchanged(directory, cached[0]):
+      self._reread(directory)
+
+  def _scan(self, directory):
+    """Lists the files of a directory by episode, and counts its videos
+    by series, returning False if it couldn't be read; its events are
+    ignored until it's listed again."""
+    names = {}
+    series = collections.Counter()
+    try:
+      with os.scandir(directory) as it:
+        for entry in it:
+          for key in _keys(entry.name):
+            names.setdefault(key, set()).add(entry.name)
+          series[_series(entry.name)] += 1
+    except OSError:
+      self._forget(directory)
+      return False
+    self._names[directory] = names
+    self._series[directory] = series
+    return True
+
+  def _forget(self, directory):
+    self._names.pop(directory, None)
+    self._series.pop(directory, None)
+
+  def _read_events(self):
+    try:
+      buf = os.read(self._fd, 65536)
+    except BlockingIOError:
+      return
+    changed = set()
+    overflow = False
+    offset = 0
+    while offset < len(buf):
+      (wd, mask, cookie, length) = _event.unpack_from(buf, offset)
+      offset += _event.size
+      name = os.fsdecode(buf[offset:offset+length].rstrip(b"\0"))
+      offset += length
+      if mask & IN_Q_OVERFLOW:
+        overflow = True
+        continue
+      directory = self._dirs.get(wd)
+      if directory == None:
+        continue
+      if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+        del self._dirs[wd]
+        self._forget(directory)
+        continue
+      if name.lower() in find.subtitle_dirs:
+        self._reread(directory)
+      elif self._apply(directory, name,
+                       bool(mask & (IN_CREATE | IN_MOVED_TO))):
+        changed.add(directory)
+    if overflow:
+      #events were lost: applying the next ones would hide the changes
+      #they carried, so every directory is read again
+      for directory in set(self._dirs.values()):
+        if self._scan(directory):
+          self._reread(directory)
+          changed.add(directory)
+    if changed:
+      try:
+        self.index.save_index()
+      except IOError:
+        pass
+
+  def _apply(self, directory, name, created):
+    """Applies the creation or deletion of a file to the index.
+
+    The videos of an episode are grouped by series as in the whole
+    directory; if the file changes whether the directory holds more than
+    one series, the whole directory is read again.
+    """
+    keys = _keys(name)
+    names = self._names.get(directory)
+    if not keys or names == None:
+      return False
+    series = self._series[directory]
+    grouped = _grouped(series)
+    known = any(name in names.get(key, ()) for key in keys)
+    if created and not known:
+      series[_series(name)] += 1
+    elif not created and known:
+      series[_series(name)] -= 1
+    for key in keys:
+      if created:
+        names.setdefault(key, set()).add(name)
+      else:
+        names.get(key, set()).discard(name)
+    cached = self.index.get(directory)
+    if cached == None:
+      return False
+    if _grouped(series) != grouped:
+      self._reread(directory)
+      return True
+    (signature, episodes) = cached
+    episodes = dict(episodes)
+    for key in keys:
+      folder_subs = [s for s in episodes.get(key, {}).get("subs", ())
+                     if os.sep in s[0]]
+      if key not in episodes and len(signature) > 1:
+        #the subtitles in the folders of a new episode aren't known
+        self._reread(directory)
+        return True
+      found = find.index_directory(names.get(key, ()),
+                                   grouped=grouped).get(key)
+      if found == None:
+        episodes.pop(key, None)
+      else:
+        if folder_subs:
+          found.setdefault("subs", []).extend(folder_subs)
+        episodes[key] = found
+    try:
+      mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+      return False
+    self.index[directory] = (((signature[0][0], mtime),) + signature[1:],
+                             episodes)
+    return True
+
+  def _reread(self, directory):
+    try:
+      (signature, episodes, subdirs) = find.read_directory(directory)
+    except OSError:
+      #the index can't be kept up to date: the mtime check takes over
+      self._forget(directory)
+      return
+    self.index[directory] = (signature, episodes)
+
+def _keys(name):
+  info = find.classify(name)
+  if info.extension in find.set_extensions or\
+     info.extension in find.subtitle_extensions:
+    return info.keys
+  return frozenset()
+
+def _series(name):
+  #the series of a video, "" for other files and videos without one
+  info = find.classify(name)
+  return info.series if info.extension in find.set_extensions else ""
+
+def _grouped(series):
+  #as in find.index_directory()
+  return sum(1 for (s, count) in series.items() if s and count > 0) > 1
+
+def start(index = None):
+  """Starts a Watcher on every directory of an index.
+
+  Directories indexed later are watched as well.
+
+  Args:
+    index: Optional. The find.Index to keep up to date. Default value:
+           find.index.
+
+  Returns:
+    The Watcher, or None if inotify isn't available.
+  """
+  try:
+    watcher = Watcher(index)
+  except OSError:
+    return None
+  watcher.index.watcher = watcher
+  watcher.start()
+  watcher.watch_index()
+  return watcher
+
+if __name__ == "__main__":
+  #checks that the episodes of a directory holding more than one series
+  #are kept apart as files are created and deleted
+  import sys
+  import time
+  import shutil
+  import tempfile
+  import data
+  def touch(*paths):
+    for path in paths:
+      open(path, "w").close()
+  def lookup(name, season, episode):
+    try:
+      return os.path.basename(find.find_file(data.Entry(name, season,
+                                                        episode, root)))
+    except find.NotFoundError:
+      return None
+  def settle():
+    #the events are applied by the thread of the watcher
+    time.sleep(0.5)
+  #the index is saved elsewhere, as saving it would change the mtime of
+  #the directory, which would be listed again at each lookup
+  (root, index_dir) = (tempfile.mkdtemp(), tempfile.mkdtemp())
+  find.index = find.Index(os.path.join(index_dir, find.index_name))
+  watcher = start()
+  if watcher == None:
+    sys.exit("inotify isn't available")
+  show_a = os.path.join(root, "Show.A.S01E0{}.720p.mkv")
+  show_b = os.path.join(root, "Show.B.S01E0{}.720p.mkv")
+  touch(show_a.format(5), show_b.format(4))
+  find.index.episodes(root)
+  settle()
+  checks = []
+  touch(show_a.format(6))
+  settle()
+  checks.append((lookup("Show B", 1, 6), None))
+  checks.append((lookup("Show A", 1, 6), "Show.A.S01E06.720p.mkv"))
+  touch(show_b.format(6))
+  settle()
+  checks.append((lookup("Show B", 1, 6), "Show.B.S01E06.720p.mkv"))
+  #with one series left, the names don't matter anymore
+  os.remove(show_b.format(4))
+  os.remove(show_b.format(6))
+  settle()
+  checks.append((lookup("Other", 1, 5), "Show.A.S01E05.720p.mkv"))
+  #the watcher may still be saving the index
+  for path in (root, index_dir):
+    shutil.rmtree(path, ignore_errors=True)
+  failed = [(got, wanted) for (got, wanted) in checks if got != wanted]
+  for (got, wanted) in failed:
+    print("found {}, expected {}".format(got, wanted))
+  print("{} of {} checks passed".format(len(checks) - len(failed),
+                                        len(checks)))
+  sys.exit(1 if failed else 0)